@@ -57,6 +57,8 @@ def add_runtime_args(parser: argparse.ArgumentParser):
     group.add_argument("--do-valid", action="store_true")
     group.add_argument("--do-eval", action="store_true")
     group.add_argument("--do-infer", action="store_true")
+    group.add_argument("--score-dtype", type=str, default="float32", choices=["float32", "float16"],
+                       help="dtype of the score store written by the LM inference.")
     group.add_argument('--base-path', type=str, default=None, help='Path to the project base directory.')
     group.add_argument('--load', type=str, default=None,
                        help='Path to a directory containing a model checkpoint.')
@@ -102,6 +104,8 @@ def add_data_args(parser: argparse.ArgumentParser):
     group.add_argument("--test-data-dir", type=str, default=None)
     group.add_argument("--processed-data-dir", type=str, default=None)
     group.add_argument("--data-process-workers", type=int, default=0)
+    group.add_argument("--tokenized-cache-dir", type=str, default=None,
+                       help="Directory of the tokenized cache for json/txt data. Default: <data-dir>/tokenized_cache.")
     group.add_argument("--precompute-data-order", action="store_true")
     group.add_argument("--train-num", type=int, default=None)
     group.add_argument("--train-ratio", type=float, default=1)
@@ -117,6 +121,12 @@ def add_data_args(parser: argparse.ArgumentParser):
     group.add_argument("--max-prompt-length", type=int, default=512)
     group.add_argument("--min-prompt-length", type=int, default=128)
     group.add_argument("--ada-max-length", action="store_true")
+    group.add_argument("--length-bucketing", action="store_true",
+                       help="Group training samples of similar lengths into batches. Used with --ada-max-length.")
+    group.add_argument("--bucket-size", type=int, default=100,
+                       help="Number of global batches in a length bucket.")
+    group.add_argument("--pack-samples", action="store_true",
+                       help="Pack several samples into each max-length row with document-aware attention masks.")
     group.add_argument("--trunc-data", action="store_true")
     group.add_argument("--json-data", action="store_true")
     group.add_argument("--bin-data", action="store_true")
@@ -141,6 +151,28 @@ def add_data_args(parser: argparse.ArgumentParser):
     group.add_argument("--max-sample-num", type=int, default=None)
     group.add_argument("--shard-start", type=int, default=0)
     group.add_argument("--shard-end", type=int, default=None)
+    group.add_argument("--encode-batch-size", type=int, default=1000,
+                       help="Number of documents sent to a tokenization worker at a time.")
+    group.add_argument("--data-n-nodes", type=int, default=1,
+                       help="Number of nodes the data processing is split over (not the training --n-nodes).")
+    group.add_argument("--data-node-rank", type=int, default=0,
+                       help="Rank of this node when the data processing is split over --data-n-nodes nodes.")
+    group.add_argument("--chunk-workers", type=int, default=0,
+                       help="Number of domain-sharded processes chunking the tokenized documents. 0: chunk in the main process.")
+    group.add_argument("--dedup", action="store_true",
+                       help="Remove exact and near-duplicate (MinHash + LSH) documents before chunking.")
+    group.add_argument("--dedup-num-perm", type=int, default=128)
+    group.add_argument("--dedup-bands", type=int, default=8,
+                       help="Number of LSH bands. The similarity threshold is about (1/bands)^(bands/num_perm).")
+    group.add_argument("--dedup-ngram", type=int, default=5,
+                       help="Length of the token n-gram shingles in MinHash.")
+    group.add_argument("--dedup-store-shards", type=int, default=16)
+    group.add_argument("--text-sidecar", action="store_true",
+                       help="Also write the raw text of the chunks (zstd compressed) next to each shard, "
+                            "which convert_tokenization.py encodes instead of decoding the old tokens.")
+    group.add_argument("--telemetry-interval", type=float, default=60,
+                       help="Seconds between the per-stage timing records appended to telemetry.jsonl "
+                            "by the data processing scripts. 0: only one record at the end.")
 
     return parser
 
@@ -290,6 +322,7 @@ def get_args():
     
     assert args.model_type is not None
     assert args.data_name is not None
+    assert not (args.pack_samples and args.model_type == "mamba"), "Sample packing needs an attention model"
         
     if args.type in ["pretrain"]:
         args.save = os.path.join(
@@ -1,5 +1,16 @@
 from .distributed_indexed import DistributedMMapIndexedDataset
 from .prompt_datasets import PromptDataset
 from .lm_datasets import LMDataset
+from .samplers import ResumableDistributedSampler, LengthBucketedDistributedSampler
+from .permutation import FeistelPermutation, PermutedDataOrder, mix64
+from .prefetcher import DevicePrefetcher
+from .manifest import get_node_output_path, write_manifest, stitch_manifests
+from .text_sidecar import TextSidecar, text_sidecar_exists, write_text_sidecar
+from .telemetry import Telemetry
+from .token_translation import TokenTranslator, is_byte_level
+from .score_store import ScoreStore, score_store_exists
+from .selection import select_top_k, top_k_ordered, score_histogram, selection_levels, level_counts, save_selection, load_selection
+from .token_alignment import token_byte_lengths, align_tokens, encode_alignment, decode_alignment, project_to_new_tokens
 
 from .indexed_dataset import make_builder, ChunkedDatasetBuilder, best_fitting_dtype
+from .gather import gather_samples
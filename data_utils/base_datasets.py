@@ -1,11 +1,11 @@
 import os
 from torch.utils.data import Dataset
 from .distributed_indexed import DistributedMMapIndexedDataset
+from .tokenized_cache import load_tokenized_json, load_tokenized_txt
+from .lazy_jsonl import LazyJsonl, LazyAnswers
 
 from torch.distributed import get_rank, get_world_size, is_initialized
 from utils import print_rank
-from tqdm import tqdm
-import json
 import numpy as np
 
 
@@ -29,26 +29,22 @@ class BaseDataset(Dataset):
         self.min_prompt_length = args.min_prompt_length
         self.max_prompt_length = args.max_prompt_length
         self.answers = None
+        self.origin_data = None
         self.order = None
         self.epoch = 0
-        self.skip_offset = (-1, -1)
         self.ada_max_length = ada_max_length or self.args.ada_max_length
 
         self.load_data(**kwargs)
         
-        if os.path.exists(os.path.join(data_path, f"{self.split}_{self.args.model_type}.jsonl")):
-            with open(os.path.join(data_path, f"{self.split}_{self.args.model_type}.jsonl")) as f:
-                self.raw = [json.loads(line) for line in f.readlines()]
-                self.answers = [x["output"] if isinstance(x["output"], list) else [x["output"]] for x in self.raw]
-        elif os.path.exists(os.path.join(data_path, f"{split}.jsonl")):
-            with open(os.path.join(data_path, f"{split}.jsonl")) as f:
-                self.raw = [json.loads(line) for line in f.readlines()]
-                self.answers = [x["output"] if isinstance(x["output"], list) else [x["output"]] for x in self.raw]
+        json_path = self.get_json_path(data_path)
+        if json_path is not None:
+            self.raw = LazyJsonl(json_path, cache_dir=self.args.tokenized_cache_dir)
+            self.answers = LazyAnswers(self.raw)
+            self.origin_data = self.raw
         else:
             print_rank("WARNING: No answers exist")
         
-        if self.answers is not None:
-            self.label_map = {tokenizer.encode(x[0], add_special_tokens=False)[0]: x[0] for x in self.answers}
+        self.label_map = None
             
         self.num = min(num, len(self.data)) if num is not None else len(self.data)
         assert self.num is not None and self.num > 0
@@ -61,7 +57,7 @@ class BaseDataset(Dataset):
         if self.args.bin_data:
             self.data = self.load_data_bin(self.data_path, **kwargs)
         elif self.args.json_data:
-            self.data, self.origin_data = self.load_data_json(self.data_path)
+            self.data = self.load_data_json(self.data_path)
         else:
             # txt data
             self.data = self.load_data_txt(self.data_path)
@@ -79,51 +75,45 @@ class BaseDataset(Dataset):
                                                     )        
         return data
 
-    def load_data_json(self, data_path):
+    def get_json_path(self, data_path):
         if os.path.exists(os.path.join(data_path, f"{self.split}_{self.args.model_type}.jsonl")):
-            data_path = os.path.join(data_path, f"{self.split}_{self.args.model_type}.jsonl")
+            return os.path.join(data_path, f"{self.split}_{self.args.model_type}.jsonl")
+        elif os.path.exists(os.path.join(data_path, f"{self.split}.jsonl")):
+            return os.path.join(data_path, f"{self.split}.jsonl")
         else:
-            data_path = os.path.join(data_path, f"{self.split}.jsonl")
-        
-        with open(data_path) as f:
-            lines = f.readlines()
-        data_origin = [json.loads(line) for line in lines]
-        data = []
+            return None
+
+    def load_data_json(self, data_path):
+        data_path = self.get_json_path(data_path)
         print_rank("Loading Data")
-        for d in tqdm(data_origin, disable=(get_rank() != 0)):
-            prompt = d["prompt"].replace("<n>", "\n")
-            prompt_ids = self.tokenizer.encode(prompt)
-            output_ids = None
-            if "output" in d:
-                if isinstance(d["output"], list):
-                    output_ids = self.tokenizer.encode(d["output"][0])
-                else:
-                    output_ids = self.tokenizer.encode(d["output"])
-            data.append({
-                "prompt_ids": prompt_ids,
-                "output_ids": output_ids
-            })
+        data = load_tokenized_json(self.args, self.tokenizer, data_path, cache_dir=self.args.tokenized_cache_dir)
         print_rank("Load End")
-        return data, data_origin
+        return data
 
     def load_data_txt(self, data_path):
-        with open(os.path.join(data_path, f"{self.split}.txt")) as f:
-            lines = f.readlines()
-        data = []
         print_rank("Loading Data")
-        for line in lines:
-            line = line.strip()
-            line = line.replace("<n>", "\n")
-            prompt = self.tokenizer.encode(line)
-            data.append(prompt)
+        data = load_tokenized_txt(self.args, self.tokenizer, os.path.join(data_path, f"{self.split}.txt"), cache_dir=self.args.tokenized_cache_dir)
         print_rank("Load End")
         return data
 
+    def get_sizes(self):
+        # token numbers of the first self.num samples, read without decoding the data
+        if self.args.bin_data:
+            return self.data.get_all_sizes()[:self.num]
+        else:
+            # json/txt data: from the index of the tokenized cache
+            return np.array(self.data.sizes[:self.num])
+
     def verbalizer(self):
+        if self.label_map is None and self.answers is not None:
+            self.label_map = {self.tokenizer.encode(x[0], add_special_tokens=False)[0]: x[0] for x in self.answers}
         return self.label_map
 
-    def set_order(self, path):
-        self.order = np.load(path, mmap_mode="r")
+    def set_order(self, order):
+        # order: path to a saved (epochs, num) array, or an object indexed by order[epoch, index]
+        if isinstance(order, str):
+            order = np.load(order, mmap_mode="r")
+        self.order = order
         assert self.order.shape[1] <= self.num
         
     def set_epoch(self, epoch):
@@ -132,9 +122,6 @@ class BaseDataset(Dataset):
     def set_num(self, num):
         self.num = num
 
-    def set_skip_offset(self, skip_offset):
-        self.skip_offset = tuple(skip_offset)
-
     def __len__(self):
         raise NotImplementedError()
     
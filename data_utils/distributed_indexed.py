@@ -260,6 +260,20 @@ class DistributedMMapIndexedDataset(torch.utils.data.Dataset):
     @property
     def sizes(self):
         return self._index.sizes
+
+    def get_all_sizes(self):
+        # sizes of all valid samples across shards, read from the index files only
+        sizes = []
+        for state in range(self.min_state, self.max_state):
+            if self._do_probe:
+                source_file = os.path.join(self._path, self._name + f"_{state}")
+            else:
+                source_file = os.path.join(self._path, self._name)
+            index = self.Index(index_file_path(source_file))
+            sizes.append(np.array(index.sizes))
+            del index
+        sizes = np.concatenate(sizes)
+        return sizes[self.min_offset:self.min_offset+self.valid_length]
         
     def exists(self, path):
         return (
@@ -0,0 +1,90 @@
+import os
+import numpy as np
+import multiprocessing as mp
+
+from .distributed_indexed import DistributedMMapIndexedDataset
+from .indexed_dataset import MMapIndexedDataset, index_file_path, data_file_path
+
+
+# Write the samples `indices` (ascending global ids) of a sharded dataset to {split}_{i}.bin/.idx
+# shards of chunk_num_per_shard samples, the same files as ChunkedDatasetBuilder would write with
+# add_np_item on each sample. Each output shard is written by one process: the selected samples are
+# grouped by source shard and cut into runs of consecutive samples, and each run is copied from the
+# source .bin file at once (copy_file_range if the dtype does not change).
+
+
+def _contiguous_runs(local_indices):
+    # starts and ends of the runs of consecutive indices
+    breaks = np.flatnonzero(np.diff(local_indices) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.append(breaks, len(local_indices))
+    return local_indices[starts], local_indices[ends - 1] + 1
+
+
+def _copy_bytes(src, dst, offset, count):
+    if hasattr(os, "copy_file_range"):
+        try:
+            while count > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), count, offset)
+                if copied == 0:
+                    break
+                offset += copied
+                count -= copied
+        except OSError:
+            # e.g. EXDEV across file systems on older kernels, ENOSYS/EINVAL on some network or
+            # overlay file systems: the rest is read and written
+            pass
+    if count > 0:
+        src.seek(offset)
+        dst.write(src.read(count))
+
+
+def _write_shard(task):
+    data_path, name, output_path, split, dtype, ofid, shard_ranges, indices = task
+    sizes = []
+    bin_file = os.path.join(output_path, f"{split}_{ofid}.bin")
+    # unbuffered, the writes and copy_file_range both go to the current position of the file
+    with open(bin_file, "wb", buffering=0) as dst:
+        # the source shards of the samples
+        states = np.searchsorted(shard_ranges[:, 1], indices, side="right")
+        for state in np.unique(states):
+            source = os.path.join(data_path, f"{name}_{state}")
+            index = MMapIndexedDataset.Index(index_file_path(source), skip_warmup=True)
+            local_indices = indices[states == state] - shard_ranges[state, 0]
+            sizes.append(index.sizes[local_indices])
+            run_starts, run_ends = _contiguous_runs(local_indices)
+            itemsize = np.dtype(index.dtype).itemsize
+            byte_starts = index._pointers[run_starts]
+            byte_ends = index._pointers[run_ends - 1] + index.sizes[run_ends - 1].astype(np.int64) * itemsize
+            with open(data_file_path(source), "rb") as src:
+                if np.dtype(index.dtype) == np.dtype(dtype):
+                    for st, ed in zip(byte_starts.tolist(), byte_ends.tolist()):
+                        _copy_bytes(src, dst, st, ed - st)
+                else:
+                    data = np.memmap(src, dtype=np.uint8, mode="r")
+                    for st, ed in zip(byte_starts.tolist(), byte_ends.tolist()):
+                        dst.write(data[st:ed].view(index.dtype).astype(dtype).tobytes())
+                    del data
+            del index
+    sizes = np.concatenate(sizes + [np.zeros(0, dtype=np.int32)])
+    print("Writing to {}".format(bin_file))
+    with MMapIndexedDataset.Index.writer(os.path.join(output_path, f"{split}_{ofid}.idx"), dtype) as index:
+        index.write(sizes, [0])
+    return ofid, len(sizes), int(np.sum(sizes, dtype=np.int64))
+
+
+def gather_samples(data_path, name, indices, output_path, dtype, split="data", chunk_num_per_shard=1000000,
+                   num_workers=8, output_start_state=0):
+    # returns the number of samples and of tokens of each output shard
+    indices = np.asarray(indices, dtype=np.int64)
+    assert np.all(np.diff(indices) > 0), "The indices must be ascending and unique"
+    dataset = DistributedMMapIndexedDataset(data_path, name)
+    shard_ranges = np.array([dataset.history[state] for state in range(dataset.max_state)], dtype=np.int64).reshape(-1, 2)
+    assert len(indices) == 0 or indices[-1] < shard_ranges[-1, 1], "Index out of range"
+    os.makedirs(output_path, exist_ok=True)
+    tasks = [(data_path, name, output_path, split, dtype, output_start_state + k, shard_ranges, indices[st:st+chunk_num_per_shard])
+             for k, st in enumerate(range(0, len(indices), chunk_num_per_shard))]
+    if num_workers <= 1 or len(tasks) <= 1:
+        return [_write_shard(task) for task in tasks]
+    with mp.Pool(processes=min(num_workers, len(tasks))) as pool:
+        return pool.map(_write_shard, tasks)
@@ -12,6 +12,7 @@
 
 from functools import lru_cache
 import os
+import time
 import shutil
 import struct
 from itertools import accumulate
@@ -19,6 +20,8 @@ from itertools import accumulate
 import numpy as np
 import torch
 
+from .text_sidecar import write_text_sidecar
+
 
 def best_fitting_dtype(vocab_size=None):
     if vocab_size is not None and vocab_size < 65500:
@@ -115,6 +118,10 @@ def data_file_path(prefix_path):
     return prefix_path + '.bin'
 
 
+def domain_file_path(prefix_path):
+    return prefix_path + '.domain.npy'
+
+
 def create_doc_idx(sizes):
     doc_idx = [0]
     for i, s in enumerate(sizes):
@@ -132,12 +139,16 @@ class ChunkedDatasetBuilder():
                  chunk_num_per_shard=1000000,
                  tmp_output_path=None,
                  do_shuffle=False,
-                 output_start_state=0):
+                 output_start_state=0,
+                 text_sidecar=False,
+                 telemetry=None):
         self.base_path = base_path
         self.split = split
         self.ofid = output_start_state
         self.dtype = dtype
         self.do_shuffle = do_shuffle
+        # also write the raw text segments of the chunks to {split}_{ofid}.text.zst
+        self.text_sidecar = text_sidecar
         self.output_path = output_path
         self.bin_file = os.path.join(self.output_path, f"{self.split}_{self.ofid}.bin")
         self.idx_file = os.path.join(self.output_path, f"{self.split}_{self.ofid}.idx")
@@ -150,20 +161,62 @@ class ChunkedDatasetBuilder():
         else:
             self.builder = make_builder(self.bin_file, impl="mmap", dtype=dtype)
         self._chunks = []
-    
-    def add_np_item(self, item):
+        self._texts = []
+        # the domain label of each chunk, written to {split}_{ofid}.domain.npy if given
+        self._labels = []
+        # data_utils.Telemetry, times the shard writes
+        self.telemetry = telemetry
+
+    def _shuffle(self):
+        # permutation(n) draws the same random numbers as shuffle, so the chunk order does not depend on text_sidecar
+        perm = np.random.permutation(len(self._chunks))
+        self._chunks = [self._chunks[i] for i in perm]
+        if self.text_sidecar:
+            self._texts = [self._texts[i] for i in perm]
+        if len(self._labels) > 0:
+            self._labels = [self._labels[i] for i in perm]
+        print("Shuffling chunks in shard {}.".format(self.ofid))
+
+    def _write_texts(self):
+        if self.text_sidecar:
+            bin_file = self.tmp_bin_file if self.tmp_output_path is not None else self.bin_file
+            write_text_sidecar(bin_file[:-len(".bin")], self._texts)
+            self._texts = []
+
+    def _write_labels(self):
+        if len(self._labels) > 0:
+            assert len(self._labels) == len(self._chunks)
+            bin_file = self.tmp_bin_file if self.tmp_output_path is not None else self.bin_file
+            np.save(domain_file_path(bin_file[:-len(".bin")]), np.array(self._labels, dtype=np.int16))
+            self._labels = []
+
+    def _write_shard(self):
+        st = time.time()
+        if self.do_shuffle:
+            self._shuffle()
+        print("Writing to {}".format(self.bin_file))
+        self.builder.add_np_items(self._chunks)
+        if self.tmp_output_path is not None:
+            self.builder.finalize(self.tmp_idx_file)
+        else:
+            self.builder.finalize(self.idx_file)
+        self._write_texts()
+        self._write_labels()
+        if self.telemetry is not None:
+            self.telemetry.add("write", time.time() - st, nbytes=sum(chunk.nbytes for chunk in self._chunks))
+        self._chunks = []
+
+    def add_np_item(self, item, texts=None, label=None):
+        # texts: the raw text segments of the item (split by eos), required with text_sidecar
+        # label: the domain label index of the item
         self._chunks.append(np.array(item, dtype=self.dtype))
+        if self.text_sidecar:
+            assert texts is not None
+            self._texts.append(texts)
+        if label is not None:
+            self._labels.append(label)
         if len(self._chunks) % self.chunk_num_per_shard == 0:
-            if self.do_shuffle:
-                np.random.shuffle(self._chunks)
-                print("Shuffling chunks in shard {}.".format(self.ofid))
-            print("Writing to {}".format(self.bin_file))
-            self.builder.add_np_items(self._chunks)
-            if self.tmp_output_path is not None:
-                self.builder.finalize(self.tmp_idx_file)
-            else:
-                self.builder.finalize(self.idx_file)
-            self._chunks = []
+            self._write_shard()
 
             self.ofid += 1
             self.bin_file = os.path.join(self.output_path, f"{self.split}_{self.ofid}.bin")
@@ -179,16 +232,7 @@ class ChunkedDatasetBuilder():
     def finalize(self):
         print("Finalizing at {}".format(self.bin_file))
         if len(self._chunks) > 0:
-            if self.do_shuffle:
-                np.random.shuffle(self._chunks)
-                print("Shuffling chunks in shard {}.".format(self.ofid))
-            print("Writing to {}".format(self.bin_file))
-            self.builder.add_np_items(self._chunks)
-            if self.tmp_output_path is not None:
-                self.builder.finalize(self.tmp_idx_file)
-            else:
-                self.builder.finalize(self.idx_file)
-            self._chunks = []
+            self._write_shard()
 
 class IndexedDataset(torch.utils.data.Dataset):
     """Loader for IndexedDataset"""
@@ -418,13 +462,8 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
                 @staticmethod
                 def _get_pointers(sizes):
                     dtype_size = dtype().itemsize
-                    address = 0
-                    pointers = []
-
-                    for size in sizes:
-                        pointers.append(address)
-                        address += size * dtype_size
-
+                    pointers = np.zeros(len(sizes), dtype=np.int64)
+                    np.cumsum(np.asarray(sizes, dtype=np.int64)[:-1] * dtype_size, out=pointers[1:])
                     return pointers
 
                 def write(self, sizes, doc_idx):
@@ -524,7 +563,7 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         return self._path
 
     def __setstate__(self, state):
-        self._do_init(state)
+        self._do_init(state, skip_warmup=True)
 
     def _do_init(self, path, skip_warmup):
         self._path = path
@@ -0,0 +1,90 @@
+import os
+import json
+import mmap
+import numpy as np
+import torch.distributed as dist
+
+
+def build_line_offsets(path, block_size=64*1024*1024):
+    offsets = [np.zeros(1, dtype=np.int64)]
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        start = 0
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n")) + start + 1
+            offsets.append(ends.astype(np.int64))
+            start += len(block)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != size:
+        # the last line has no trailing newline
+        offsets = np.append(offsets, size)
+    return offsets
+
+
+class LazyJsonl():
+    def __init__(self, path, cache_dir=None):
+        self.path = path
+        cache_dir = cache_dir or os.path.join(os.path.dirname(path), "tokenized_cache")
+        stat = os.stat(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        offsets_path = os.path.join(cache_dir, f"{name}_{stat.st_size}_{int(stat.st_mtime)}_offsets.npy")
+        if not dist.is_initialized() or dist.get_rank() == 0:
+            if not os.path.exists(offsets_path):
+                os.makedirs(cache_dir, exist_ok=True)
+                print(f"Building line offsets of {path} to {offsets_path}")
+                np.save(offsets_path, build_line_offsets(path))
+        if dist.is_initialized():
+            dist.barrier()
+        self.offsets = np.load(offsets_path, mmap_mode="r")
+        self._file = None
+        self._mmap = None
+
+    def _open(self):
+        self._file = open(self.path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_mmap"] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        if self._mmap is None:
+            self._open()
+        return json.loads(self._mmap[self.offsets[index]:self.offsets[index+1]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __del__(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+
+
+class LazyAnswers():
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, index):
+        x = self.raw[index]
+        return x["output"] if isinstance(x["output"], list) else [x["output"]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -11,9 +11,6 @@ class LMDataset(BaseDataset):
         return self.num
 
     def __getitem__(self, index: int):
-        if (self.epoch, index) < self.skip_offset:
-            return None
-
         if self.order is not None:
             index = int(self.order[self.epoch, index])
 
@@ -22,10 +19,9 @@ class LMDataset(BaseDataset):
         return index, data
 
     def collate(self, samples):
-        
-        if samples[0] is None:
-            return None, None
-        
+        if self.args.pack_samples:
+            return self.collate_packed(samples)
+
         bs = len(samples)
         if self.ada_max_length:
             max_length = max([len(samp[1]) for samp in samples])
@@ -59,10 +55,64 @@ class LMDataset(BaseDataset):
             
         return model_batch, no_model_batch
     
-    def collate_gen(self, samples):
-        if samples[0] is None:
-            return None, None
+    def _pack(self, lengths):
+        # first-fit decreasing: returns the row and the start position of each sample
+        row_lens = []
+        placement = [None] * len(lengths)
+        for i in sorted(range(len(lengths)), key=lambda x: -lengths[x]):
+            for r in range(len(row_lens)):
+                if row_lens[r] + lengths[i] <= self.max_length:
+                    placement[i] = (r, row_lens[r])
+                    row_lens[r] += lengths[i]
+                    break
+            else:
+                placement[i] = (len(row_lens), 0)
+                row_lens.append(lengths[i])
+        return placement, row_lens
+
+    def collate_packed(self, samples):
+        # Pack several samples into each row. Tokens of a sample only attend to the same sample:
+        #   position_ids restart at every sample,
+        #   attention_mask is a (rows, 1, L, L) boolean block-diagonal causal mask.
+        # Per-sample losses are recovered with segment_ids (the position of the sample in `samples`, -1 for padding).
+        bs = len(samples)
+        all_full_ids = [data[:self.max_length+1] for _, data in samples]
+        lengths = [len(full_ids)-1 for full_ids in all_full_ids]
+        placement, row_lens = self._pack(lengths)
+        n_rows = len(row_lens)
+        max_length = max(row_lens) if self.ada_max_length else self.max_length
+
+        model_batch = {
+            "input_ids": torch.ones(n_rows, max_length, dtype=torch.long) * self.pad_id,
+            "attention_mask": torch.zeros(n_rows, 1, max_length, max_length, dtype=torch.bool),
+            "position_ids": torch.zeros(n_rows, max_length, dtype=torch.long),
+        }
         
+        no_model_batch = {
+            "label": torch.ones(n_rows, max_length, dtype=torch.long) * self.pad_id,
+            "loss_mask": torch.zeros(n_rows, max_length, dtype=torch.float),
+            "segment_ids": torch.ones(n_rows, max_length, dtype=torch.long) * -1,
+            "idx": torch.zeros(bs, dtype=torch.long)
+        }
+
+        causal_mask = torch.tril(torch.ones(max_length, max_length, dtype=torch.bool))
+        for i, ((idx, _), full_ids, (r, st)) in enumerate(zip(samples, all_full_ids, placement)):
+            ed = st + lengths[i]
+            model_batch["input_ids"][r][st:ed] = torch.tensor(full_ids[:-1], dtype=torch.long)
+            model_batch["attention_mask"][r, 0, st:ed, st:ed] = causal_mask[:ed-st, :ed-st]
+            model_batch["position_ids"][r][st:ed] = torch.arange(0, ed-st, dtype=torch.long)
+            no_model_batch["label"][r][st:ed] = torch.tensor(full_ids[1:], dtype=torch.long)
+            no_model_batch["loss_mask"][r][st:ed] = (torch.tensor(full_ids[:-1], dtype=torch.long) != self.pad_id)
+            no_model_batch["segment_ids"][r][st:ed] = i
+            no_model_batch["idx"][i] = idx
+        
+        for r in range(n_rows):
+            # padding positions only attend to themselves
+            model_batch["attention_mask"][r, 0, row_lens[r]:, row_lens[r]:] |= torch.eye(max_length-row_lens[r], dtype=torch.bool)
+
+        return model_batch, no_model_batch
+
+    def collate_gen(self, samples):
         bs = len(samples)
         max_prompt_length = max([len(samp[1]) for samp in samples])
         max_rest_length = max([len(samp[2]) for samp in samples])
@@ -0,0 +1,87 @@
+import os
+import json
+
+from .indexed_dataset import MMapIndexedDataset, data_file_path, index_file_path, domain_file_path
+from .text_sidecar import text_file_path, text_index_file_path, text_sidecar_exists
+
+
+MANIFEST_NAME = "manifest.json"
+
+
+def get_node_output_path(output_path, node_rank, n_nodes):
+    # with several nodes, each node writes its shards to its own sub-directory
+    if n_nodes == 1:
+        return output_path
+    return os.path.join(output_path, f"node_{node_rank}")
+
+
+def list_shards(path, split="data", start_state=0):
+    # the complete (.bin and .idx) shards {split}_{start_state}, {split}_{start_state+1}, ... in path
+    shards = []
+    state = start_state
+    while True:
+        prefix = os.path.join(path, f"{split}_{state}")
+        if not (os.path.exists(data_file_path(prefix)) and os.path.exists(index_file_path(prefix))):
+            break
+        index = MMapIndexedDataset.Index(index_file_path(prefix), skip_warmup=True)
+        shards.append({"id": state, "num_samples": len(index)})
+        del index
+        state += 1
+    return shards
+
+
+def write_manifest(path, split="data", start_state=0, **info):
+    manifest = {"split": split, "shards": list_shards(path, split, start_state), **info}
+    with open(os.path.join(path, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def stitch_manifests(output_path, n_nodes, split="data", start_state=0):
+    # Move the shards of all nodes to output_path as {split}_{start_state}, {split}_{start_state+1}, ...
+    # in the node order. Only files are renamed, no data is copied.
+    manifests = []
+    for node_rank in range(n_nodes):
+        node_path = get_node_output_path(output_path, node_rank, n_nodes)
+        manifest_path = os.path.join(node_path, MANIFEST_NAME)
+        assert os.path.exists(manifest_path), f"Manifest not found: {manifest_path}. Is node {node_rank} finished?"
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        assert manifest["split"] == split, (manifest["split"], split)
+        assert (manifest["node_rank"], manifest["n_nodes"]) == (node_rank, n_nodes), (manifest["node_rank"], manifest["n_nodes"])
+        assert [x["id"] for x in manifest["shards"]] == [x["id"] for x in list_shards(node_path, split)], \
+            f"Shards in {node_path} do not match the manifest"
+        manifests.append(manifest)
+
+    # the text sidecar (--text-sidecar) moves with its shard, all shards or none must have one
+    has_text = [text_sidecar_exists(os.path.join(get_node_output_path(output_path, node_rank, n_nodes), f"{split}_{shard['id']}"))
+                for node_rank, manifest in enumerate(manifests) for shard in manifest["shards"]]
+    assert all(has_text) or not any(has_text), \
+        f"Only {sum(has_text)} of {len(has_text)} shards have a text sidecar"
+
+    ofid = start_state
+    shards = []
+    for node_rank, manifest in enumerate(manifests):
+        node_path = get_node_output_path(output_path, node_rank, n_nodes)
+        for shard in manifest["shards"]:
+            src = os.path.join(node_path, f"{split}_{shard['id']}")
+            dst = os.path.join(output_path, f"{split}_{ofid}")
+            assert not os.path.exists(data_file_path(dst)), f"{data_file_path(dst)} already exists"
+            os.rename(data_file_path(src), data_file_path(dst))
+            os.rename(index_file_path(src), index_file_path(dst))
+            text_sidecar = text_sidecar_exists(src)
+            if text_sidecar:
+                os.rename(text_file_path(src), text_file_path(dst))
+                os.rename(text_index_file_path(src), text_index_file_path(dst))
+            # the domain labels of the samples
+            domain_labels = os.path.exists(domain_file_path(src))
+            if domain_labels:
+                os.rename(domain_file_path(src), domain_file_path(dst))
+            shards.append({"id": ofid, "node_rank": node_rank, "num_samples": shard["num_samples"],
+                           "text_sidecar": text_sidecar, "domain_labels": domain_labels})
+            ofid += 1
+
+    manifest = {"split": split, "n_nodes": n_nodes, "shards": shards, "nodes": manifests}
+    with open(os.path.join(output_path, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
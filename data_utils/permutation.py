@@ -0,0 +1,76 @@
+import numpy as np
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def mix64(x):
+    # splitmix64 finalizer, x is an uint64 array (wraps around on overflow)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+class FeistelPermutation():
+    # A seedable bijection over [0, num): a balanced Feistel network over the smallest
+    # even-bit domain covering num, restricted to [0, num) by cycle walking.
+    def __init__(self, num, seed, rounds=4):
+        assert num > 0
+        self.num = num
+        half_bits = max(1, ((num - 1).bit_length() + 1) // 2)
+        self.half_bits = np.uint64(half_bits)
+        self.mask = np.uint64((1 << half_bits) - 1)
+        keys = mix64(np.arange(rounds, dtype=np.uint64) + np.uint64(seed & _MASK64) * np.uint64(rounds + 1))
+        self.keys = [np.uint64(k) for k in keys]
+
+    def _encrypt(self, x):
+        left, right = x >> self.half_bits, x & self.mask
+        for key in self.keys:
+            left, right = right, left ^ (mix64(right ^ key) & self.mask)
+        return (left << self.half_bits) | right
+
+    def __call__(self, indices):
+        x = np.atleast_1d(np.asarray(indices, dtype=np.uint64))
+        out = self._encrypt(x)
+        # the domain is less than 4 * num, so this loop ends after a few rounds in expectation
+        todo = np.flatnonzero(out >= self.num)
+        while len(todo) > 0:
+            out[todo] = self._encrypt(out[todo])
+            todo = todo[out[todo] >= self.num]
+        return out.astype(np.int64)
+
+
+class PermutedDataOrder():
+    # Drop-in replacement of the materialized (epochs, num) data order: order[epoch, index].
+    # Positions are evaluated vectorized in contiguous chunks and cached per epoch.
+    def __init__(self, num, epochs, seed, chunk_size=65536):
+        self.num = num
+        self.epochs = epochs
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self._perms = {}
+        self._chunks = {}
+
+    @property
+    def shape(self):
+        return (self.epochs, self.num)
+
+    def get_perm(self, epoch):
+        if epoch not in self._perms:
+            self._perms[epoch] = FeistelPermutation(self.num, self.seed * 1000003 + epoch)
+        return self._perms[epoch]
+
+    def get_order(self, epoch, indices):
+        return self.get_perm(epoch)(indices)
+
+    def __getitem__(self, key):
+        epoch, index = key
+        if not isinstance(index, (int, np.integer)):
+            return self.get_order(epoch, index)
+        assert 0 <= index < self.num, (index, self.num)
+        cid = index // self.chunk_size
+        if self._chunks.get(epoch, (None, None))[0] != cid:
+            st = cid * self.chunk_size
+            ed = min(st + self.chunk_size, self.num)
+            self._chunks[epoch] = (cid, self.get_order(epoch, np.arange(st, ed)))
+        return self._chunks[epoch][1][index - cid * self.chunk_size]
@@ -0,0 +1,58 @@
+import torch
+
+
+class DevicePrefetcher():
+    # Wraps a DataLoader and copies batch i+1 to the device on a side stream while batch i is computed.
+    # Falls back to plain synchronous copies when the device is not a cuda device.
+    def __init__(self, dataloader, device):
+        self.dataloader = dataloader
+        self.device = torch.device("cuda", device) if isinstance(device, int) else torch.device(device)
+        self.use_cuda = self.device.type == "cuda" and torch.cuda.is_available()
+        self.stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _to_device(self, x):
+        if isinstance(x, torch.Tensor):
+            if self.use_cuda and not x.is_pinned():
+                x = x.pin_memory()
+            return x.to(self.device, non_blocking=self.use_cuda)
+        elif isinstance(x, dict):
+            return {k: self._to_device(v) for k, v in x.items()}
+        elif isinstance(x, (list, tuple)):
+            return type(x)(self._to_device(v) for v in x)
+        else:
+            return x
+
+    def _record_stream(self, x):
+        if isinstance(x, torch.Tensor):
+            x.record_stream(torch.cuda.current_stream(self.device))
+        elif isinstance(x, dict):
+            for v in x.values():
+                self._record_stream(v)
+        elif isinstance(x, (list, tuple)):
+            for v in x:
+                self._record_stream(v)
+
+    def _preload(self, data_iter):
+        try:
+            batch = next(data_iter)
+        except StopIteration:
+            return None
+        if self.use_cuda:
+            with torch.cuda.stream(self.stream):
+                return self._to_device(batch)
+        else:
+            return self._to_device(batch)
+
+    def __iter__(self):
+        data_iter = iter(self.dataloader)
+        next_batch = self._preload(data_iter)
+        while next_batch is not None:
+            if self.use_cuda:
+                torch.cuda.current_stream(self.device).wait_stream(self.stream)
+                self._record_stream(next_batch)
+            batch = next_batch
+            next_batch = self._preload(data_iter)
+            yield batch
@@ -15,9 +15,6 @@ class PromptDataset(BaseDataset):
         return self.num
 
     def __getitem__(self, index: int):
-        if (self.epoch, index) < self.skip_offset:
-            return None
-
         if self.order is not None:
             index = int(self.order[self.epoch, index])
 
@@ -50,10 +47,6 @@ class PromptDataset(BaseDataset):
         return index, prompt_ids, response_ids
 
     def collate(self, samples):
-        
-        if samples[0] is None:
-            return None, None
-        
         bs = len(samples)
         if self.ada_max_length:
             max_length = max([len(samp[1]) + len(samp[2]) for samp in samples])
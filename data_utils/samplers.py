@@ -0,0 +1,82 @@
+import numpy as np
+from torch.utils.data import DistributedSampler
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    # sample_cursor: number of samples consumed by all ranks in the current epoch.
+    # It is a multiple of num_replicas at any optimizer step boundary.
+    def __init__(self, dataset, **kwargs):
+        super().__init__(dataset, **kwargs)
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        self.start = 0
+
+    def set_start(self, sample_cursor):
+        assert sample_cursor % self.num_replicas == 0, (sample_cursor, self.num_replicas)
+        self.start = sample_cursor // self.num_replicas
+
+    def __iter__(self):
+        indices = list(super().__iter__())
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return max(self.num_samples - self.start, 0)
+
+
+class LengthBucketedDistributedSampler(ResumableDistributedSampler):
+    # Shuffles the samples, sorts them by length inside buckets of `bucket_size` global batches
+    # and cuts each bucket into global batches of similar length. The order of the global
+    # batches is shuffled again. Every rank gets the same number of batches, and the ranks
+    # share the length profile of every step.
+    def __init__(self, dataset, sizes, batch_size, max_length, bucket_size=100, **kwargs):
+        super().__init__(dataset, drop_last=True, **kwargs)
+        self.batch_size = batch_size
+        self.global_batch_size = batch_size * self.num_replicas
+        self.bucket_size = bucket_size
+        self.lengths = np.minimum(np.asarray(sizes[:len(dataset)], dtype=np.int64), max_length + 1) - 1
+        self.num_batches = len(self.lengths) // self.global_batch_size
+        self.num_samples = self.num_batches * self.batch_size
+        self.total_size = self.num_batches * self.global_batch_size
+        self.indices = None
+        self.padding_stats = None
+        self.set_epoch(0)
+
+    def _padded_tokens(self, batches):
+        lengths = self.lengths[batches]
+        return int(np.sum(lengths.max(axis=-1, keepdims=True) - lengths))
+
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        g = np.random.default_rng(self.seed + epoch)
+        if self.shuffle:
+            perm = g.permutation(len(self.lengths))[:self.total_size]
+        else:
+            perm = np.arange(self.total_size)
+
+        # sort inside each bucket
+        bucket_len = self.bucket_size * self.global_batch_size
+        sorted_perm = []
+        for st in range(0, self.total_size, bucket_len):
+            bucket = perm[st:st+bucket_len]
+            sorted_perm.append(bucket[np.argsort(self.lengths[bucket], kind="stable")])
+        sorted_perm = np.concatenate(sorted_perm)
+
+        # (num_batches, num_replicas, batch_size), shuffle the global batches
+        global_batches = sorted_perm.reshape(self.num_batches, self.num_replicas, self.batch_size)
+        if self.shuffle:
+            global_batches = global_batches[g.permutation(self.num_batches)]
+        self.indices = global_batches[:, self.rank].reshape(-1)
+
+        total_tokens = int(np.sum(self.lengths[perm]))
+        random_padding = self._padded_tokens(perm.reshape(-1, self.batch_size))
+        bucketed_padding = self._padded_tokens(global_batches.reshape(-1, self.batch_size))
+        self.padding_stats = {
+            "random_padding_fraction": random_padding / (total_tokens + random_padding),
+            "bucketed_padding_fraction": bucketed_padding / (total_tokens + bucketed_padding),
+            "saved_padding_tokens": random_padding - bucketed_padding,
+        }
+
+    def __iter__(self):
+        return iter(self.indices[self.start:].tolist())
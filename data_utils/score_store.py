@@ -0,0 +1,70 @@
+import os
+import numpy as np
+
+
+# Per-sample scores (e.g. the LM losses of pretrain/inferer.py) in a preallocated memmap indexed by
+# the sample id, with a bitmap of the samples that have been scored:
+#   {path}/scores.npy: (num_samples,) float32 or float16
+#   {path}/valid.npy: (ceil(num_samples / 8),) uint8, bit i (little-endian bit order) is set when sample i is scored
+# The inference writes the scores in place, the later stages open the arrays with np.load(mmap_mode="r"),
+# so the scores are neither merged nor fully loaded into memory.
+
+# the number of set bits of each byte
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+
+def score_store_exists(path):
+    return os.path.exists(os.path.join(path, "scores.npy")) and os.path.exists(os.path.join(path, "valid.npy"))
+
+
+class ScoreStore():
+    def __init__(self, path, num_samples=None, dtype=np.float32, mode="r"):
+        # mode "r": read only, "r+": write into an existing store, "w": create the store, or open it
+        # as "r+" if it exists (resumed inference)
+        self.path = path
+        scores_path = os.path.join(path, "scores.npy")
+        valid_path = os.path.join(path, "valid.npy")
+        if mode == "w" and score_store_exists(path):
+            mode = "r+"
+        if mode == "w":
+            os.makedirs(path, exist_ok=True)
+            self.scores = np.lib.format.open_memmap(scores_path, mode="w+", dtype=dtype, shape=(num_samples,))
+            self.valid = np.lib.format.open_memmap(valid_path, mode="w+", dtype=np.uint8, shape=((num_samples + 7) // 8,))
+        else:
+            self.scores = np.load(scores_path, mmap_mode=mode)
+            self.valid = np.load(valid_path, mmap_mode=mode)
+            assert num_samples is None or num_samples == len(self.scores), \
+                f"The score store {path} has {len(self.scores)} samples, not {num_samples}"
+
+    def __len__(self):
+        return len(self.scores)
+
+    def write(self, start, values, valid=None):
+        # scores of the samples [start, start + len(values)), valid: the mask of the scored ones (default: all).
+        # Overwrites the range: the samples not in valid are marked as unscored.
+        end = start + len(values)
+        self.scores[start:end] = values
+        valid = np.ones(len(values), dtype=bool) if valid is None else np.asarray(valid, dtype=bool)
+        # the bitmap bytes covering [start, end)
+        bst, bed = start // 8, (end + 7) // 8
+        bits = np.unpackbits(self.valid[bst:bed], bitorder="little")
+        bits[start-bst*8:end-bst*8] = valid
+        self.valid[bst:bed] = np.packbits(bits, bitorder="little")
+
+    def valid_mask(self, start=0, end=None):
+        end = len(self) if end is None else end
+        bits = np.unpackbits(self.valid[start//8:(end+7)//8], bitorder="little")
+        return bits[start%8:start%8+end-start].astype(bool)
+
+    def num_valid(self):
+        return int(_POPCOUNT[self.valid].sum())
+
+    def iter_blocks(self, block_size=1 << 24):
+        # (start, scores, valid mask) of consecutive blocks, so that the scores are never all in memory
+        for st in range(0, len(self), block_size):
+            ed = min(st + block_size, len(self))
+            yield st, np.asarray(self.scores[st:ed]), self.valid_mask(st, ed)
+
+    def flush(self):
+        self.scores.flush()
+        self.valid.flush()
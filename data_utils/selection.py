@@ -0,0 +1,153 @@
+import os
+import json
+import numpy as np
+
+
+# Top-k selection over a ScoreStore in O(n) time and bounded memory, without sorting the scores.
+# Only the valid (scored) samples are selected. The k-th largest score is found with a histogram
+# pass and np.partition on the samples of its histogram bin, then the selected indices are
+# collected in ascending order in one sweep. Ties at the threshold are broken by the sample index.
+# For several ratios, selection_levels computes all the (nested) selections in the same passes.
+
+
+def _valid_blocks(store, largest, block_size):
+    # (start, scores of the block, valid mask), with the scores negated for the smallest ones
+    for st, scores, valid in store.iter_blocks(block_size):
+        scores = scores.astype(np.float64)
+        yield st, (scores if largest else -scores), valid
+
+
+def score_range(store, largest=True, block_size=1 << 24):
+    # min, max (of the negated scores if not largest) and the number of valid scores
+    lo, hi, num = np.inf, -np.inf, 0
+    for _, scores, valid in _valid_blocks(store, largest, block_size):
+        scores = scores[valid]
+        if len(scores) > 0:
+            lo, hi = min(lo, scores.min()), max(hi, scores.max())
+            num += len(scores)
+    return lo, hi, num
+
+
+def _bin_ids(scores, lo, hi, bins):
+    scale = bins / (hi - lo) if hi > lo else 0.0
+    return np.clip(((scores - lo) * scale).astype(np.int64), 0, bins - 1)
+
+
+def _histogram(store, lo, hi, bins, largest, block_size):
+    counts = np.zeros(bins, dtype=np.int64)
+    for _, scores, valid in _valid_blocks(store, largest, block_size):
+        counts += np.bincount(_bin_ids(scores[valid], lo, hi, bins), minlength=bins)
+    return counts
+
+
+def score_histogram(store, bins, largest=True, block_size=1 << 24):
+    # counts and edges of a histogram of the valid scores with uniform bins
+    lo, hi, _ = score_range(store, largest, block_size)
+    return _histogram(store, lo, hi, bins, largest, block_size), np.linspace(lo, hi, bins + 1)
+
+
+def top_k_thresholds(store, ks, largest=True, bins=1 << 16, block_size=1 << 24):
+    # for each k, the k-th largest valid score (k-th smallest if not largest, negated), and the
+    # number of the scores equal to it that are among the top k. The passes are shared by all ks.
+    lo, hi, num = score_range(store, largest, block_size)
+    ks = [min(k, num) for k in ks]
+    if all(k <= 0 for k in ks):
+        return [(np.inf, 0) for _ in ks]
+    counts = _histogram(store, lo, hi, bins, largest, block_size)
+    # the bin of the k-th largest score, and the number of the scores in the bins above it
+    above = np.cumsum(counts[::-1]) - counts[::-1]
+    ps = [int(np.searchsorted(above + counts[::-1], k)) for k in ks]
+    target_bins = np.unique([bins - 1 - p for k, p in zip(ks, ps) if k > 0])
+    candidates = {b: [] for b in target_bins.tolist()}
+    for _, scores, valid in _valid_blocks(store, largest, block_size):
+        scores = scores[valid]
+        bin_ids = _bin_ids(scores, lo, hi, bins)
+        for b in candidates:
+            candidates[b].append(scores[bin_ids == b])
+    candidates = {b: np.concatenate(x) for b, x in candidates.items()}
+    results = []
+    for k, p in zip(ks, ps):
+        if k <= 0:
+            results.append((np.inf, 0))
+            continue
+        num_above = int(above[p])
+        bin_scores = candidates[bins - 1 - p]
+        r = k - num_above
+        threshold = np.partition(bin_scores, len(bin_scores) - r)[len(bin_scores) - r]
+        results.append((threshold, k - num_above - int(np.sum(bin_scores > threshold))))
+    return results
+
+
+def top_k_threshold(store, k, largest=True, bins=1 << 16, block_size=1 << 24):
+    return top_k_thresholds(store, [k], largest, bins, block_size)[0]
+
+
+def selection_levels(store, ks, largest=True, bins=1 << 16, block_size=1 << 24):
+    # one pass for several k (ascending): the level of a sample is the first j such that it is
+    # among the top ks[j], 255 if none. The top-k sets are nested, so the selection of ks[j] is
+    # np.flatnonzero(levels <= j), the same as select_top_k(store, ks[j]).
+    assert list(ks) == sorted(ks) and len(ks) < 255
+    thresholds = top_k_thresholds(store, ks, largest, bins, block_size)
+    num_ties = [t for _, t in thresholds]
+    levels = np.full(len(store), 255, dtype=np.uint8)
+    for st, scores, valid in _valid_blocks(store, largest, block_size):
+        block_levels = levels[st:st+len(scores)]
+        # the larger sets first, so that a sample keeps the smallest level
+        for j in reversed(range(len(ks))):
+            threshold = thresholds[j][0]
+            selected = valid & (scores > threshold)
+            ties = np.flatnonzero(valid & (scores == threshold))[:num_ties[j]]
+            selected[ties] = True
+            num_ties[j] -= len(ties)
+            block_levels[selected] = j
+    return levels
+
+
+def level_counts(levels, num_levels, weights=None, groups=None, num_groups=1, block_size=1 << 24):
+    # the (weighted) number of the samples selected at each level, cumulative over the levels,
+    # per group if groups is given: (num_levels, num_groups)
+    counts = np.zeros((num_levels + 1) * num_groups, dtype=np.float64)
+    for st in range(0, len(levels), block_size):
+        block_levels = np.minimum(np.asarray(levels[st:st+block_size]).astype(np.int64), num_levels)
+        keys = block_levels * num_groups + (np.asarray(groups[st:st+block_size]) if groups is not None else 0)
+        counts += np.bincount(keys, weights=None if weights is None else np.asarray(weights[st:st+block_size], dtype=np.float64),
+                              minlength=len(counts))
+    return np.cumsum(counts.reshape(num_levels + 1, num_groups)[:num_levels], axis=0)
+
+
+def select_top_k(store, k, largest=True, bins=1 << 16, block_size=1 << 24):
+    # the ascending indices of the k valid samples with the largest (smallest) scores
+    threshold, num_ties = top_k_threshold(store, k, largest, bins, block_size)
+    indices = []
+    for st, scores, valid in _valid_blocks(store, largest, block_size):
+        selected = valid & (scores > threshold)
+        ties = np.flatnonzero(valid & (scores == threshold))[:num_ties]
+        selected[ties] = True
+        num_ties -= len(ties)
+        indices.append(np.flatnonzero(selected) + st)
+    return np.concatenate(indices + [np.zeros(0, dtype=np.int64)])
+
+
+def top_k_ordered(store, k, largest=True, bins=1 << 16, block_size=1 << 24):
+    # the indices of the top k samples ordered by score, for small k
+    indices = select_top_k(store, k, largest, bins, block_size)
+    scores = np.asarray(store.scores[indices]).astype(np.float64)
+    order = np.argsort(-scores if largest else scores, kind="stable")
+    return indices[order]
+
+
+def save_selection(path, ratios, levels, report=None):
+    # {path}/levels.npy and {path}/selection.json (the ratios of the levels and the report)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "levels.npy"), levels)
+    with open(os.path.join(path, "selection.json"), "w") as f:
+        json.dump({"ratios": list(ratios), "report": report}, f, indent=4)
+
+
+def load_selection(path, ratio):
+    # the ascending indices selected at one of the saved ratios, a view of the saved levels
+    with open(os.path.join(path, "selection.json")) as f:
+        ratios = json.load(f)["ratios"]
+    assert ratio in ratios, f"Ratio {ratio} is not in the selection {path}: {ratios}"
+    levels = np.load(os.path.join(path, "levels.npy"), mmap_mode="r")
+    return np.flatnonzero(levels <= ratios.index(ratio))
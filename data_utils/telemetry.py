@@ -0,0 +1,85 @@
+import json
+import time
+import threading
+
+
+# Per-stage counters and timers of the preprocessing pipelines, appended as one JSON record per
+# `interval` seconds to a .jsonl file. Each record covers the window since the previous one:
+#   stages: {name: {"seconds", "count", "bytes", "fraction"}}, fraction = seconds / window.
+#           The stages named "worker/..." are timed in the pool workers, their total over
+#           num_workers * window is the busy fraction of the workers (above 1 when a worker
+#           runs several threads, e.g. the rust tokenizers).
+#   gauges: {name: {"last", "max", "mean"}} of the sampled values, e.g. queue depths.
+#   totals: the cumulative values passed to step().
+
+
+class Telemetry():
+    def __init__(self, path, interval=60, num_workers=1):
+        self.path = path
+        self.interval = interval
+        self.num_workers = num_workers
+        # stages may be timed in background threads
+        self.lock = threading.Lock()
+        self.global_start = time.time()
+        self._reset(self.global_start)
+
+    def _reset(self, now):
+        self.window_start = now
+        self.stages = {}
+        self.gauges = {}
+
+    def add(self, stage, seconds, count=1, nbytes=0):
+        with self.lock:
+            stats = self.stages.setdefault(stage, {"seconds": 0.0, "count": 0, "bytes": 0})
+            stats["seconds"] += seconds
+            stats["count"] += count
+            stats["bytes"] += nbytes
+
+    def gauge(self, name, value):
+        with self.lock:
+            stats = self.gauges.setdefault(name, {"last": 0, "max": 0, "sum": 0, "n": 0})
+            stats["last"] = value
+            stats["max"] = max(stats["max"], value)
+            stats["sum"] += value
+            stats["n"] += 1
+
+    def timed(self, items, stage, nbytes=None):
+        # iterate items, timing how long each item takes to be produced
+        it = iter(items)
+        while True:
+            st = time.time()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.add(stage, time.time() - st, nbytes=nbytes(item) if nbytes is not None else 0)
+            yield item
+
+    def step(self, **totals):
+        if self.interval > 0 and time.time() - self.window_start >= self.interval:
+            self.flush(**totals)
+
+    def flush(self, **totals):
+        now = time.time()
+        with self.lock:
+            window = max(now - self.window_start, 1e-6)
+            stages = {}
+            worker_seconds = 0.0
+            for stage, stats in sorted(self.stages.items()):
+                stages[stage] = dict(stats, fraction=stats["seconds"] / window)
+                if stage.startswith("worker/"):
+                    worker_seconds += stats["seconds"]
+            gauges = {name: {"last": stats["last"], "max": stats["max"], "mean": stats["sum"] / stats["n"]}
+                      for name, stats in sorted(self.gauges.items())}
+            record = {
+                "time": now,
+                "elapsed": now - self.global_start,
+                "window": window,
+                "workers": {"num": self.num_workers, "busy_fraction": worker_seconds / (self.num_workers * window)},
+                "stages": stages,
+                "gauges": gauges,
+                "totals": totals,
+            }
+            self._reset(now)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
@@ -0,0 +1,84 @@
+import os
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# The raw text of the chunks of a shard, stored next to {prefix}.bin/.idx as
+#   {prefix}.text.zst: one zstd frame per block of `block_size` chunks
+#   {prefix}.text_idx.npz: frame byte offsets, and the character offsets of the text segments
+# The text of a chunk is a list of segments, one per (part of a) document in the chunk, i.e. the
+# pieces between the eos tokens of the chunk.
+
+
+def text_file_path(prefix_path):
+    return prefix_path + ".text.zst"
+
+
+def text_index_file_path(prefix_path):
+    return prefix_path + ".text_idx.npz"
+
+
+def text_sidecar_exists(prefix_path):
+    return os.path.exists(text_file_path(prefix_path)) and os.path.exists(text_index_file_path(prefix_path))
+
+
+def write_text_sidecar(prefix_path, chunk_texts, block_size=1024, level=3):
+    assert zstandard is not None, "The text sidecar requires zstandard: pip install zstandard"
+    compressor = zstandard.ZstdCompressor(level=level)
+    frame_offsets, block_char_offsets = [0], [0]
+    chunk_offsets, segment_offsets = [0], [0]
+    with open(text_file_path(prefix_path), "wb") as f:
+        for st in range(0, len(chunk_texts), block_size):
+            block = []
+            for segments in chunk_texts[st:st+block_size]:
+                for segment in segments:
+                    block.append(segment)
+                    segment_offsets.append(segment_offsets[-1] + len(segment))
+                chunk_offsets.append(chunk_offsets[-1] + len(segments))
+            frame = compressor.compress("".join(block).encode("utf-8"))
+            f.write(frame)
+            frame_offsets.append(frame_offsets[-1] + len(frame))
+            block_char_offsets.append(segment_offsets[-1])
+    np.savez(text_index_file_path(prefix_path),
+             block_size=np.array(block_size),
+             frame_offsets=np.array(frame_offsets, dtype=np.int64),
+             block_char_offsets=np.array(block_char_offsets, dtype=np.int64),
+             chunk_offsets=np.array(chunk_offsets, dtype=np.int64),
+             segment_offsets=np.array(segment_offsets, dtype=np.int64))
+
+
+class TextSidecar():
+    def __init__(self, prefix_path):
+        assert zstandard is not None, "The text sidecar requires zstandard: pip install zstandard"
+        self.path = text_file_path(prefix_path)
+        index = np.load(text_index_file_path(prefix_path))
+        self.block_size = int(index["block_size"])
+        self.frame_offsets = index["frame_offsets"]
+        self.block_char_offsets = index["block_char_offsets"]
+        self.chunk_offsets = index["chunk_offsets"]
+        self.segment_offsets = index["segment_offsets"]
+        self._block_id, self._block = None, None
+
+    def __len__(self):
+        return len(self.chunk_offsets) - 1
+
+    def _get_block(self, block_id):
+        if block_id != self._block_id:
+            with open(self.path, "rb") as f:
+                f.seek(self.frame_offsets[block_id])
+                frame = f.read(self.frame_offsets[block_id+1] - self.frame_offsets[block_id])
+            self._block = zstandard.ZstdDecompressor().decompress(frame).decode("utf-8")
+            self._block_id = block_id
+        return self._block
+
+    def __getitem__(self, index):
+        # the text segments of chunk `index`
+        block_id = index // self.block_size
+        block = self._get_block(block_id)
+        base = self.block_char_offsets[block_id]
+        st, ed = self.chunk_offsets[index], self.chunk_offsets[index+1]
+        return [block[self.segment_offsets[s]-base:self.segment_offsets[s+1]-base] for s in range(st, ed)]
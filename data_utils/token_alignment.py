@@ -0,0 +1,83 @@
+import numpy as np
+
+from .token_translation import is_byte_level
+
+
+# Alignment of the converted tokens to the old tokens of a sample: new token j covers the old tokens
+# [old_starts[j], old_ends[j]) of the sample, by the bytes of the text they decode to. The eos tokens
+# that join the segments of a sample are aligned to each other.
+# It is stored as uint16 [old_starts[0], diff(old_starts)..., old_ends - old_starts...] per sample.
+
+
+def token_byte_lengths(tokenizer):
+    # the number of text bytes of each token, 0 for the special tokens
+    if is_byte_level(tokenizer):
+        # one character per byte in the byte-level alphabet
+        lengths = np.array([len(token) for token in tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))], dtype=np.int64)
+    else:
+        lengths = np.array([len(token.encode("utf-8")) for token in tokenizer.batch_decode([[i] for i in range(len(tokenizer))])], dtype=np.int64)
+    for i, token in tokenizer.added_tokens_decoder.items():
+        lengths[i] = 0 if token.special else len(token.content.encode("utf-8"))
+    lengths[tokenizer.all_special_ids] = 0
+    return lengths
+
+
+def align_tokens(old_tokens, old_byte_lengths, old_eos_token_id, new_segments, new_byte_lengths):
+    # old_tokens: a sample, new_segments: the new tokens of its pieces between the eos tokens.
+    # Returns old_starts, old_ends of the new tokens joined by eos (as in convert_tokenization.py).
+    # Each eos counts as one byte, and the bytes of a new segment are clipped to the old one, so
+    # that a segment whose text does not round-trip exactly does not shift the others.
+    old_tokens = np.asarray(old_tokens, dtype=np.int64)
+    is_eos = old_tokens == old_eos_token_id
+    old_lengths = np.where(is_eos, 1, old_byte_lengths[old_tokens])
+    old_ends = np.cumsum(old_lengths)
+    old_starts = old_ends - old_lengths
+
+    # the byte range of each old segment
+    eos_poses = np.flatnonzero(is_eos)
+    seg_ends = np.append(old_starts[eos_poses], old_ends[-1] if len(old_ends) > 0 else 0)
+    seg_starts = np.concatenate([[0], old_ends[eos_poses]])
+    assert len(new_segments) == len(seg_starts)
+
+    new_starts, new_ends = [], []
+    for k, segment in enumerate(new_segments):
+        ends = np.cumsum(new_byte_lengths[np.asarray(segment, dtype=np.int64)])
+        starts = ends - new_byte_lengths[np.asarray(segment, dtype=np.int64)]
+        new_starts.append(np.minimum(seg_starts[k] + starts, seg_ends[k]))
+        new_ends.append(np.minimum(seg_starts[k] + ends, seg_ends[k]))
+        if k + 1 < len(new_segments):
+            # the joining eos
+            new_starts.append(seg_ends[k:k+1])
+            new_ends.append(seg_ends[k:k+1] + 1)
+    new_starts = np.concatenate(new_starts + [np.zeros(0, dtype=np.int64)])
+    new_ends = np.concatenate(new_ends + [np.zeros(0, dtype=np.int64)])
+
+    # the old tokens that end after the new token starts and start before it ends
+    align_starts = np.searchsorted(old_ends, new_starts, side="right")
+    align_ends = np.maximum(np.searchsorted(old_starts, new_ends, side="left"), align_starts)
+    return align_starts, align_ends
+
+
+def encode_alignment(old_starts, old_ends):
+    deltas = np.concatenate([np.diff(old_starts, prepend=0), old_ends - old_starts])
+    assert np.all(deltas >= 0) and np.all(deltas <= np.iinfo(np.uint16).max)
+    return deltas.astype(np.uint16)
+
+
+def decode_alignment(alignment):
+    alignment = np.asarray(alignment, dtype=np.int64)
+    n = len(alignment) // 2
+    old_starts = np.cumsum(alignment[:n])
+    return old_starts, old_starts + alignment[n:]
+
+
+def project_to_new_tokens(values, old_starts, old_ends, reduce="mean"):
+    # per-old-token values (e.g. teacher log-probs, along the first axis) reduced over the old span of
+    # each new token. Empty spans get 0.
+    values = np.asarray(values, dtype=np.float64)
+    cum = np.concatenate([np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0)])
+    sums = cum[old_ends] - cum[old_starts]
+    if reduce == "sum":
+        return sums
+    counts = (old_ends - old_starts).reshape((-1,) + (1,) * (values.ndim - 1))
+    return sums / np.maximum(counts, 1)
@@ -0,0 +1,106 @@
+import numpy as np
+
+
+# Translate token ids of an old tokenizer to a new tokenizer without decoding and re-encoding the
+# whole text, for byte-level BPE tokenizers (Qwen, LLaMA-3, GPT-NeoX/Mamba, Falcon).
+# Their pre-tokenizers always split the text between a non-whitespace character and " " + letter,
+# and BPE never merges across the pre-tokens. So the old tokens are cut into spans at the token
+# boundaries of this kind, and each span is translated on its own:
+#   spans of one token: a precomputed table, old token -> new tokens
+#   longer spans: decode + encode, cached
+# The result equals tokenizer_new.encode(tokenizer_old.decode(tokens, skip_special_tokens=True)).
+# convert_tokenization.py checks this on samples before using the translation.
+
+
+def range_indices(starts, lengths):
+    # the concatenation of arange(starts[k], starts[k] + lengths[k])
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) > 0 else 0)
+
+
+def is_byte_level(tokenizer):
+    decoder = getattr(getattr(tokenizer, "backend_tokenizer", None), "decoder", None)
+    return decoder is not None and decoder.__class__.__name__ == "ByteLevel"
+
+
+class TokenTranslator():
+    def __init__(self, tokenizer_old, tokenizer_new, max_cache_size=1000000):
+        assert is_byte_level(tokenizer_old) and is_byte_level(tokenizer_new), "Token translation requires byte-level BPE tokenizers"
+        self.tokenizer_old = tokenizer_old
+        self.tokenizer_new = tokenizer_new
+        self.max_cache_size = max_cache_size
+        vocab_tokens = tokenizer_old.batch_decode([[i] for i in range(len(tokenizer_old))], skip_special_tokens=True)
+        # the boundary before token b is a span boundary if the token before ends with a non-whitespace
+        # character and b starts with " " + letter. "�" is a partial utf-8 character.
+        self.ends_non_space = np.array([len(s) > 0 and not s[-1].isspace() and s[-1] != "�" for s in vocab_tokens], dtype=bool)
+        self.starts_space_letter = np.array([len(s) > 1 and s[0] == " " and s[1].isalpha() for s in vocab_tokens], dtype=bool)
+        # the table of single tokens, token i -> table[table_offsets[i]:table_offsets[i+1]]
+        table = tokenizer_new(vocab_tokens, add_special_tokens=False)["input_ids"]
+        self.table_offsets = np.zeros(len(table) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in table], out=self.table_offsets[1:])
+        self.table = np.array([i for x in table for i in x], dtype=np.int64)
+        self.cache = {}
+        self.num_tokens, self.num_table_tokens, self.num_cached_tokens = 0, 0, 0
+
+    def translate(self, segments):
+        # segments: a list of old token arrays, returns the concatenated new tokens and the offsets of each segment
+        lengths = np.array([len(x) for x in segments], dtype=np.int64)
+        tokens = np.concatenate([np.asarray(x, dtype=np.int64) for x in segments] + [np.zeros(0, dtype=np.int64)])
+        seg_starts = np.zeros(len(segments) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=seg_starts[1:])
+
+        # the span starts: the segment starts and the safe boundaries
+        is_start = np.zeros(len(tokens), dtype=bool)
+        is_start[1:] = self.ends_non_space[tokens[:-1]] & self.starts_space_letter[tokens[1:]]
+        is_start[seg_starts[:-1][lengths > 0]] = True
+        span_starts = np.flatnonzero(is_start)
+        span_ends = np.append(span_starts[1:], len(tokens))
+        span_segs = np.searchsorted(seg_starts, span_starts, side="right") - 1
+
+        # spans of one token are looked up in the table
+        single = np.flatnonzero(span_ends - span_starts == 1)
+        new_lengths = np.zeros(len(span_starts), dtype=np.int64)
+        table_starts = self.table_offsets[tokens[span_starts[single]]]
+        new_lengths[single] = self.table_offsets[tokens[span_starts[single]] + 1] - table_starts
+
+        # longer spans are decoded and encoded once, then cached
+        multi = np.flatnonzero(span_ends - span_starts > 1)
+        keys = [tokens[span_starts[k]:span_ends[k]].tobytes() for k in multi]
+        hits = np.array([key in self.cache for key in keys], dtype=bool)
+        misses = list(set(key for key, hit in zip(keys, hits) if not hit))
+        if len(misses) > 0:
+            if len(self.cache) + len(misses) > self.max_cache_size:
+                self.cache = {}
+            texts = self.tokenizer_old.batch_decode([np.frombuffer(key, dtype=np.int64) for key in misses], skip_special_tokens=True)
+            for key, ids in zip(misses, self.tokenizer_new(texts, add_special_tokens=False)["input_ids"]):
+                self.cache[key] = np.array(ids, dtype=np.int64)
+        extra = [self.cache[key] for key in keys]
+        new_lengths[multi] = [len(x) for x in extra]
+
+        out_starts = np.zeros(len(span_starts), dtype=np.int64)
+        np.cumsum(new_lengths[:-1], out=out_starts[1:])
+        new_tokens = np.zeros(int(np.sum(new_lengths)), dtype=np.int64)
+        new_tokens[range_indices(out_starts[single], new_lengths[single])] = self.table[range_indices(table_starts, new_lengths[single])]
+        new_tokens[range_indices(out_starts[multi], new_lengths[multi])] = np.concatenate(extra + [np.zeros(0, dtype=np.int64)])
+
+        offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(span_segs, weights=new_lengths, minlength=len(segments)).astype(np.int64), out=offsets[1:])
+
+        self.num_tokens += len(tokens)
+        self.num_table_tokens += len(single)
+        self.num_cached_tokens += int(np.sum((span_ends - span_starts)[multi][hits]))
+        return new_tokens, offsets
+
+    def slow_translate(self, segments):
+        # the reference: decode and encode each segment
+        texts = self.tokenizer_old.batch_decode([np.asarray(x, dtype=np.int64) for x in segments], skip_special_tokens=True)
+        ids = self.tokenizer_new(texts, add_special_tokens=False)["input_ids"]
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in ids], out=offsets[1:])
+        return np.array([i for x in ids for i in x], dtype=np.int64), offsets
+
+    def stats(self):
+        # the fractions of the old tokens translated by the table and by cached spans
+        return {"tokens": self.num_tokens,
+                "table_fraction": self.num_table_tokens / max(self.num_tokens, 1),
+                "cached_fraction": self.num_cached_tokens / max(self.num_tokens, 1)}
@@ -0,0 +1,173 @@
+import os
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+import torch.distributed as dist
+
+from .indexed_dataset import make_builder, best_fitting_dtype, MMapIndexedDataset, index_file_path, data_file_path
+
+
+def file_fingerprint(path, block_size=16*1024*1024):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer):
+    md5 = hashlib.md5()
+    md5.update(tokenizer.__class__.__name__.encode())
+    if getattr(tokenizer, "is_fast", False):
+        md5.update(tokenizer.backend_tokenizer.to_str().encode())
+    else:
+        md5.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode())
+    md5.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True).encode())
+    return md5.hexdigest()
+
+
+class BatchEncoder(object):
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def initializer(self):
+        # Use BatchEncoder class as a container for global data
+        BatchEncoder.tokenizer = self.tokenizer
+
+    def encode(self, texts):
+        ids = BatchEncoder.tokenizer(texts, add_special_tokens=True)["input_ids"]
+        lengths = np.array([len(x) for x in ids], dtype=np.int64)
+        buffer = np.concatenate([np.array(x, dtype=np.int64) for x in ids] + [np.zeros(0, dtype=np.int64)])
+        return buffer, lengths
+
+
+def batch_encode(tokenizer, texts, num_workers=0, batch_size=1000):
+    batches = [texts[i:i+batch_size] for i in range(0, len(texts), batch_size)]
+    encoder = BatchEncoder(tokenizer)
+    if num_workers > 0:
+        pool = multiprocessing.Pool(num_workers, initializer=encoder.initializer)
+        encoded = pool.imap(encoder.encode, batches, 1)
+    else:
+        pool = None
+        encoder.initializer()
+        encoded = map(encoder.encode, batches)
+
+    for buffer, lengths in encoded:
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        for i in range(len(lengths)):
+            yield buffer[offsets[i]:offsets[i+1]]
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+class TokenizedData():
+    def __init__(self, prefix):
+        self.data = MMapIndexedDataset(prefix, skip_warmup=True)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return self.data[int(index)].astype(int)
+
+    @property
+    def sizes(self):
+        return self.data.sizes
+
+
+class TokenizedJsonData():
+    def __init__(self, prefix):
+        self.prompt_ids = TokenizedData(prefix + "_prompt")
+        self.output_ids = TokenizedData(prefix + "_output")
+        self.has_output = np.load(prefix + "_has_output.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.prompt_ids)
+
+    @property
+    def sizes(self):
+        # prompt and output tokens of each sample
+        return self.prompt_ids.sizes.astype(np.int64) + np.where(self.has_output, self.output_ids.sizes, 0)
+
+    def __getitem__(self, index):
+        return {
+            "prompt_ids": self.prompt_ids[index],
+            "output_ids": self.output_ids[index] if self.has_output[index] else None
+        }
+
+
+def _build_cache(tokenizer, texts_dict, prefix, num_workers):
+    dtype = best_fitting_dtype(len(tokenizer))
+    for name, texts in texts_dict.items():
+        builder = make_builder(data_file_path(f"{prefix}_{name}"), impl="mmap", dtype=dtype)
+        for ids in batch_encode(tokenizer, texts, num_workers=num_workers):
+            builder.add_np_item(ids)
+        builder.finalize(index_file_path(f"{prefix}_{name}"))
+
+
+def _cache_prefix(tokenizer, path, cache_dir):
+    # only rank 0 hashes the (possibly large) file, other ranks receive the key
+    if not dist.is_initialized() or dist.get_rank() == 0:
+        key = hashlib.md5((file_fingerprint(path) + tokenizer_fingerprint(tokenizer)).encode()).hexdigest()
+    else:
+        key = None
+    if dist.is_initialized():
+        key_list = [key]
+        dist.broadcast_object_list(key_list, src=0)
+        key = key_list[0]
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f"{name}_{key}")
+
+
+def _load_or_build(args, tokenizer, path, cache_dir, read_texts, data_cls):
+    cache_dir = cache_dir or os.path.join(os.path.dirname(path), "tokenized_cache")
+    prefix = _cache_prefix(tokenizer, path, cache_dir)
+    done_file = prefix + "_done.json"
+    if not dist.is_initialized() or dist.get_rank() == 0:
+        if not os.path.exists(done_file):
+            os.makedirs(cache_dir, exist_ok=True)
+            print(f"Tokenizing {path} to cache {prefix}")
+            num = read_texts(prefix)
+            with open(done_file, "w") as f:
+                json.dump({"path": path, "num": num}, f)
+        else:
+            print(f"Load tokenized cache {prefix}")
+    if dist.is_initialized():
+        dist.barrier()
+    return data_cls(prefix)
+
+
+def load_tokenized_json(args, tokenizer, path, cache_dir=None):
+    def read_texts(prefix):
+        prompts, outputs, has_output = [], [], []
+        with open(path) as f:
+            for line in f:
+                d = json.loads(line)
+                prompts.append(d["prompt"].replace("<n>", "\n"))
+                if "output" in d:
+                    outputs.append(d["output"][0] if isinstance(d["output"], list) else d["output"])
+                    has_output.append(True)
+                else:
+                    outputs.append("")
+                    has_output.append(False)
+        _build_cache(tokenizer, {"prompt": prompts, "output": outputs}, prefix, args.data_process_workers)
+        np.save(prefix + "_has_output.npy", np.array(has_output, dtype=bool))
+        return len(prompts)
+
+    return _load_or_build(args, tokenizer, path, cache_dir, read_texts, TokenizedJsonData)
+
+
+def load_tokenized_txt(args, tokenizer, path, cache_dir=None):
+    def read_texts(prefix):
+        with open(path) as f:
+            lines = [line.strip().replace("<n>", "\n") for line in f]
+        _build_cache(tokenizer, {"text": lines}, prefix, args.data_process_workers)
+        return len(lines)
+
+    return _load_or_build(args, tokenizer, path, cache_dir, read_texts, lambda prefix: TokenizedData(prefix + "_text"))
@@ -6,6 +6,7 @@ pip3 install deepspeed
 pip3 install numerize
 pip3 install accelerate
 pip3 install datasets
+pip3 install zstandard
 pip3 install wandb
 pip3 install matplotlib
 pip3 install sentencepiece
@@ -12,7 +12,8 @@ from utils import get_rank, print_rank, all_gather, print_and_save_rank
 from train_eval_utils.base_trainer import BaseTrainer
 from data_utils.lm_datasets import LMDataset
 from torch.utils.data import DataLoader, DistributedSampler
-from data_utils import ChunkedDatasetBuilder, best_fitting_dtype
+from data_utils import ChunkedDatasetBuilder, best_fitting_dtype, ScoreStore
+from data_utils.prefetcher import DevicePrefetcher
 
 
 class PretrainInferer(BaseTrainer):
@@ -44,7 +45,7 @@ class PretrainInferer(BaseTrainer):
     def get_dataloader(self, eval_dataset: LMDataset):
         eval_sampler = DistributedSampler(eval_dataset, shuffle=False, drop_last=False, rank=self.dp_rank, num_replicas=self.dp_world_size)
         eval_dataloader = DataLoader(
-        eval_dataset, sampler=eval_sampler, batch_size=self.args.eval_batch_size, num_workers=self.args.num_workers, collate_fn=eval_dataset.collate)
+        eval_dataset, sampler=eval_sampler, batch_size=self.args.eval_batch_size, num_workers=self.args.num_workers, collate_fn=eval_dataset.collate, pin_memory=True)
         return eval_dataloader
 
     def inference(self):
@@ -56,7 +57,7 @@ class PretrainInferer(BaseTrainer):
     def gather_infer(self, all_infer_output):
         raise NotImplementedError
 
-    def save_infer(self, all_infer_output, infer_stat, save_path, save_idx=None):
+    def save_infer(self, all_infer_output, infer_stat, save_path, save_idx=None, save_offset=0):
         raise NotImplementedError
 
     def _inference_base(self):
@@ -126,10 +127,9 @@ class PretrainInferer(BaseTrainer):
         idx = self.min_shard_idx
         offset = self.min_offset
         with torch.no_grad():
-            for i, (model_batch, no_model_batch) in enumerate(tqdm(eval_dataloader, f"LM Evaluation", disable=(not get_rank() == 0))):
+            for i, (model_batch, no_model_batch) in enumerate(tqdm(DevicePrefetcher(eval_dataloader, self.device), f"LM Evaluation", disable=(not get_rank() == 0))):
                 if i == 0 and self.dp_rank == 0:
                     self.first_print(model_batch, no_model_batch)
-                eval_dataset.move_to_device(model_batch, no_model_batch, self.device)
                 infer_out = self.infer_one_batch(model_batch, no_model_batch)
                 all_infer_output.append(infer_out)
                 ct = time() - st
@@ -152,7 +152,7 @@ class PretrainInferer(BaseTrainer):
 
                     if self.dp_rank == 0:
                         infer_stat = {"num": len(all_infer_output), "time": ct}
-                        self.save_infer(all_infer_output, infer_stat, save_path, idx)
+                        self.save_infer(all_infer_output, infer_stat, save_path, idx, offset)
                         state = {
                             "idx": idx+1, # next run start from this index
                             "offset": offset + len(all_infer_output)
@@ -170,7 +170,7 @@ class PretrainInferer(BaseTrainer):
             all_infer_output = all_infer_output[:len(self.eval_dataset)-(idx-self.min_shard_idx)*num_per_shard]
             if self.dp_rank == 0:
                 infer_stat = {"num": len(all_infer_output), "time": ct}
-                self.save_infer(all_infer_output, infer_stat, save_path, idx)
+                self.save_infer(all_infer_output, infer_stat, save_path, idx, offset)
                 state = {
                     "idx": idx+1,
                     "offset": offset + len(all_infer_output)
@@ -197,16 +197,18 @@ class PretrainLMInferer(PretrainInferer):
         all_infer_output = all_gather(all_infer_output, dim=1, op="stack").view(-1)
         return all_infer_output
 
-    def save_infer(self, all_infer_output, infer_stat, save_path, save_idx=None):
+    def save_infer(self, all_infer_output, infer_stat, save_path, save_idx=None, save_offset=0):
         res = {
             "avg_loss": torch.mean(all_infer_output),
             **infer_stat
         }
         eval_log_str = self.get_log(res, "infer")
         print_and_save_rank(eval_log_str, os.path.join(save_path, "log.txt"))
-        scores_path = os.path.join(save_path, f"scores_{save_idx}.pt") if save_idx is not None else os.path.join(save_path, "scores.pt")
-        torch.save(all_infer_output, scores_path)
-        print("Inference Saved to", scores_path)
+        # written in place at the sample offset of this shard, see data_utils/score_store.py
+        store = ScoreStore(os.path.join(save_path, "scores"), self.infer_num, dtype=self.args.score_dtype, mode="w")
+        store.write(save_offset, all_infer_output.float().cpu().numpy())
+        store.flush()
+        print("Inference Saved to", store.path, "offset", save_offset)
         
         
 class PretrainGenInferer(PretrainInferer):
@@ -216,7 +218,7 @@ class PretrainGenInferer(PretrainInferer):
     def get_dataloader(self, eval_dataset: LMDataset):
         eval_sampler = DistributedSampler(eval_dataset, shuffle=False, drop_last=False, rank=self.dp_rank, num_replicas=self.dp_world_size)
         eval_dataloader = DataLoader(
-        eval_dataset, sampler=eval_sampler, batch_size=self.args.eval_batch_size, num_workers=self.args.num_workers, collate_fn=eval_dataset.collate_gen)
+        eval_dataset, sampler=eval_sampler, batch_size=self.args.eval_batch_size, num_workers=self.args.num_workers, collate_fn=eval_dataset.collate_gen, pin_memory=True)
         return eval_dataloader
     
     def infer_one_batch(self, model_batch, no_model_batch):
@@ -244,7 +246,7 @@ class PretrainGenInferer(PretrainInferer):
             
         return trimmed_ids
 
-    def save_infer(self, all_infer_output, infer_stat, save_path, save_idx=None):
+    def save_infer(self, all_infer_output, infer_stat, save_path, save_idx=None, save_offset=0):
         all_infer_output = all_infer_output.cpu().numpy()
         all_infer_output = self._trim_padding(all_infer_output)
         max_length = max([len(x) for x in all_infer_output])
@@ -6,7 +6,8 @@ import torch
 import numpy as np
 from tqdm import tqdm
 import re
-from data_utils import DistributedMMapIndexedDataset
+from data_utils import DistributedMMapIndexedDataset, ScoreStore, score_store_exists
+from data_utils import select_top_k, top_k_ordered, score_histogram
 from transformers import AutoTokenizer
 import random
 import matplotlib.pyplot as plt
@@ -18,31 +19,60 @@ def save(tokenizer, dataset, indices, scores, large_scores, small_scores, output
     with open(os.path.join(output_path), "w") as f:
         for k, idx in enumerate(tqdm(indices)):
             s = tokenizer.decode(dataset[idx], skip_special_tokens=True)
-            score = scores[idx].item()
-            large_score = large_scores[idx].item()
-            small_score = small_scores[idx].item()
+            score = scores.scores[idx].item()
+            large_score = large_scores.scores[idx].item()
+            small_score = small_scores.scores[idx].item()
             f.write(f"############## {k}, {idx}, diff: {score}, large_score: {large_score}, small_score: {small_score} #############\n")
             f.write(s + "\n\n\n")
 
 
 def compute_diff_scores(large_scores, small_scores, output_path):
-    diff_scores = small_scores - large_scores
-    print_and_save_rank("diff_scores size: {}".format(len(diff_scores)), 
+    # written block by block to the score store output_path/diff_scores, a sample is valid if both
+    # models scored it
+    diff_scores = ScoreStore(os.path.join(output_path, "diff_scores"), len(large_scores), mode="w")
+    for st, large, large_valid in large_scores.iter_blocks():
+        small, small_valid = np.asarray(small_scores.scores[st:st+len(large)]), small_scores.valid_mask(st, st+len(large))
+        diff_scores.write(st, small.astype(np.float32) - large.astype(np.float32), large_valid & small_valid)
+    diff_scores.flush()
+    print_and_save_rank("diff_scores size: {}, valid: {}".format(len(diff_scores), diff_scores.num_valid()), 
                         os.path.join(output_path, "log.txt"))
     
-    max_diff_scores = diff_scores.max()
-    min_diff_scores = diff_scores.min()
+    max_diff_scores, min_diff_scores, _ = score_stats(diff_scores)
     print_and_save_rank("max_diff_scores: {}, min_diff_scores: {}".format(
         max_diff_scores, min_diff_scores), os.path.join(output_path, "log.txt"))
 
     return diff_scores
 
 
+def score_stats(store):
+    # max, min, mean of the valid scores
+    max_scores, min_scores, sum_scores, num = -np.inf, np.inf, 0.0, 0
+    for _, scores, valid in store.iter_blocks():
+        scores = scores[valid].astype(np.float64)
+        if len(scores) > 0:
+            max_scores, min_scores = max(max_scores, scores.max()), min(min_scores, scores.min())
+            sum_scores += scores.sum()
+            num += len(scores)
+    return max_scores, min_scores, sum_scores / max(num, 1)
+
+
 def load_scores(score_path, name, output_path, use_cache=False):
-    cache_path = os.path.join(score_path, f"merged_scores.pt")
-    if use_cache and os.path.exists(cache_path):
-        print_and_save_rank(f"{name} scores load from {cache_path}", os.path.join(output_path, "log.txt"))
-        scores = torch.load(cache_path, map_location="cpu")
+    # the score store written by pretrain/inferer.py, opened without loading the scores
+    store_path = os.path.join(score_path, "scores")
+    if score_store_exists(store_path):
+        scores = ScoreStore(store_path)
+        print_and_save_rank("{} scores: {}, scored: {}".format(name, len(scores), scores.num_valid()),
+                            os.path.join(output_path, "log.txt"))
+        max_scores, min_scores, mean_scores = score_stats(scores)
+        print_and_save_rank("{} scores: mean: {}, max: {}, min: {}".format(
+            name, mean_scores, max_scores, min_scores), os.path.join(output_path, "log.txt"))
+        return scores
+
+    # the scores_{i}.pt files of older runs are merged into a store
+    store_path = os.path.join(output_path, f"{name}_scores")
+    if use_cache and score_store_exists(store_path):
+        print_and_save_rank(f"{name} scores load from {store_path}", os.path.join(output_path, "log.txt"))
+        scores = ScoreStore(store_path)
     else:    
         p = r"scores_(\d+).pt"
 
@@ -62,11 +92,12 @@ def load_scores(score_path, name, output_path, use_cache=False):
         scores = torch.cat(scores, dim=0)
         print_and_save_rank("{} score original length: {}".format(name, len(scores)), os.path.join(output_path, "log.txt"))
 
-        torch.save(scores, cache_path)        
+        store = ScoreStore(store_path, len(scores), mode="w")
+        store.write(0, scores.float().numpy())
+        store.flush()
+        scores = store
 
-    mean_scores = scores.mean()
-    max_scores = scores.max()
-    min_scores = scores.min()
+    max_scores, min_scores, mean_scores = score_stats(scores)
     print_and_save_rank("{} scores: mean: {}, max: {}, min: {}".format(
         name, mean_scores, max_scores, min_scores), os.path.join(output_path, "log.txt"))
 
@@ -74,12 +105,14 @@ def load_scores(score_path, name, output_path, use_cache=False):
 
 
 def stat(diff_scores, large_scores, small_scores, model_path, data_path, output_path):
-    sorted_scores, sorted_indices = torch.sort(diff_scores, descending=True)
+    # only the scored samples, selected without sorting the scores
+    num_valid = diff_scores.num_valid()
 
+    counts, edges = score_histogram(diff_scores, 10000)
     fig, ax1 = plt.subplots()
-    ax1.hist(diff_scores.numpy(), bins=10000, density=True, histtype='step')
+    ax1.hist(edges[:-1], bins=edges, weights=counts, density=True, histtype='step')
     ax2 = ax1.twinx()
-    ax2.hist(diff_scores.numpy(), bins=10000, cumulative=True, histtype='step', density=True, color='tab:orange')
+    ax2.hist(edges[:-1], bins=edges, weights=counts, cumulative=True, histtype='step', density=True, color='tab:orange')
     plt.savefig(os.path.join(output_path, "dist.png"))
 
     dataset = DistributedMMapIndexedDataset(data_path, "data")
@@ -88,45 +121,45 @@ def stat(diff_scores, large_scores, small_scores, model_path, data_path, output_
     
     tokenizer = AutoTokenizer.from_pretrained(model_path)
     
-    top_indices = sorted_indices[:1000].tolist()
-    bottom_indices = sorted_indices[-1000:].tolist()
+    top_indices = top_k_ordered(diff_scores, 1000).tolist()
+    bottom_indices = top_k_ordered(diff_scores, 1000, largest=False)[::-1].tolist()
 
     save(tokenizer, dataset, top_indices, diff_scores, large_scores, small_scores, 
          os.path.join(output_path, "top.txt"))
     save(tokenizer, dataset, bottom_indices, diff_scores, large_scores, small_scores, 
          os.path.join(output_path, "bottom.txt"))
 
-    top_0001 = sorted_indices[:int(len(sorted_indices) * 0.001)].tolist()
+    top_0001 = select_top_k(diff_scores, int(num_valid * 0.001)).tolist()
     random.shuffle(top_0001)
     top_0001 = top_0001[:1000]
     save(tokenizer, dataset, top_0001, diff_scores, large_scores, small_scores, 
          os.path.join(output_path, "top_0001.txt"))
     
-    top_001 = sorted_indices[:int(len(sorted_indices) * 0.01)].tolist()
+    top_001 = select_top_k(diff_scores, int(num_valid * 0.01)).tolist()
     random.shuffle(top_001)
     top_001 = top_001[:1000]
     save(tokenizer, dataset, top_001, diff_scores, large_scores, small_scores, 
          os.path.join(output_path, "top_001.txt"))
 
-    top_01 = sorted_indices[:int(len(sorted_indices) * 0.1)].tolist()
+    top_01 = select_top_k(diff_scores, int(num_valid * 0.1)).tolist()
     random.shuffle(top_01)
     top_01 = top_01[:1000]
     save(tokenizer, dataset, top_01, diff_scores, large_scores, small_scores, 
          os.path.join(output_path, "top_01.txt"))
 
-    bottom_0001 = sorted_indices[-int(len(sorted_indices) * 0.001):].tolist()
+    bottom_0001 = select_top_k(diff_scores, int(num_valid * 0.001), largest=False).tolist()
     random.shuffle(bottom_0001)
     bottom_0001 = bottom_0001[:1000]
     save(tokenizer, dataset, bottom_0001, diff_scores, large_scores, small_scores, 
          os.path.join(output_path, "bottom_0001.txt"))
     
-    bottom_001 = sorted_indices[-int(len(sorted_indices) * 0.01):].tolist()
+    bottom_001 = select_top_k(diff_scores, int(num_valid * 0.01), largest=False).tolist()
     random.shuffle(bottom_001)
     bottom_001 = bottom_001[:1000]
     save(tokenizer, dataset, bottom_001, diff_scores, large_scores, small_scores, 
          os.path.join(output_path, "bottom_001.txt"))
 
-    bottom_01 = sorted_indices[-int(len(sorted_indices) * 0.1):].tolist()
+    bottom_01 = select_top_k(diff_scores, int(num_valid * 0.1), largest=False).tolist()
     random.shuffle(bottom_01)
     bottom_01 = bottom_01[:1000]
     save(tokenizer, dataset, bottom_01, diff_scores, large_scores, small_scores, 
@@ -151,9 +184,9 @@ def main():
     #### load & save & compute ####
     large_scores = load_scores(large_score_path, "large", output_path, use_cache=True)
     small_scores = load_scores(small_score_path, "small", output_path, use_cache=True)
+    assert len(large_scores) == len(small_scores), f"{len(large_scores)} != {len(small_scores)}"
 
     diff_scores = compute_diff_scores(large_scores, small_scores, output_path)
-    torch.save(diff_scores, os.path.join(output_path, "diff_scores.pt"))
 
     #### stat ####
     stat(diff_scores, large_scores, small_scores, model_path, data_path, output_path)
@@ -8,8 +8,50 @@ import random
 from transformers import AutoTokenizer
 from tqdm import tqdm
 import re
-
-from data_utils import DistributedMMapIndexedDataset, ChunkedDatasetBuilder, best_fitting_dtype
+import json
+
+from data_utils import DistributedMMapIndexedDataset, best_fitting_dtype, ScoreStore, gather_samples
+from data_utils import selection_levels, level_counts, save_selection
+from data_utils.indexed_dataset import MMapIndexedDataset, index_file_path, domain_file_path
+from utils import print_and_save_rank
+
+
+def get_sample_infos(data_path, max_state, log_path):
+    # the length of each sample, and its domain label if all the shards have one
+    sizes, domains = [], []
+    for state in range(max_state):
+        prefix = os.path.join(data_path, f"data_{state}")
+        # the index closes its mmap when deleted, the sizes are copied before
+        index = MMapIndexedDataset.Index(index_file_path(prefix), skip_warmup=True)
+        sizes.append(np.array(index.sizes))
+        del index
+        domains.append(np.load(domain_file_path(prefix)) if os.path.exists(domain_file_path(prefix)) else None)
+    num_labeled = sum(x is not None for x in domains)
+    if 0 < num_labeled < max_state:
+        print_and_save_rank("Warning: only {} of the {} shards have domain labels ({}), the domain report is skipped".format(
+            num_labeled, max_state, [state for state, x in enumerate(domains) if x is None]), log_path)
+    domains = np.concatenate(domains).astype(np.int64) if num_labeled == max_state else None
+    return np.concatenate(sizes), domains
+
+
+def selection_report(ratios, levels, sizes, domains, domain_names):
+    # the samples and tokens selected at each ratio, in total and per domain
+    samples = level_counts(levels, len(ratios))[:, 0]
+    tokens = level_counts(levels, len(ratios), weights=sizes)[:, 0]
+    if domains is not None:
+        num_domains = max(len(domain_names), int(domains.max()) + 1)
+        domain_samples = level_counts(levels, len(ratios), groups=domains, num_groups=num_domains)
+        domain_tokens = level_counts(levels, len(ratios), weights=sizes, groups=domains, num_groups=num_domains)
+        all_tokens = np.bincount(domains, weights=sizes, minlength=num_domains)
+    report = {}
+    for j, ratio in enumerate(ratios):
+        report[str(ratio)] = {"samples": int(samples[j]), "tokens": int(tokens[j]), "token_fraction": float(tokens[j] / max(np.sum(sizes), 1))}
+        if domains is not None:
+            report[str(ratio)]["domains"] = {
+                domain_names.get(d, str(d)): {"samples": int(domain_samples[j, d]), "tokens": int(domain_tokens[j, d]),
+                                              "kept_token_fraction": float(domain_tokens[j, d] / max(all_tokens[d], 1))}
+                for d in range(num_domains) if all_tokens[d] > 0}
+    return report
 
 
 def main():
@@ -20,42 +62,66 @@ def main():
     model_path = os.path.join(base_path, "checkpoints/qwen/200M/")
     data_path = os.path.join(base_path, "processed_data/pretrain/pile/qwen-1025")
 
-    ratio = float(sys.argv[2])
-
-    score_path = os.path.join(base_path, f"results/lm_infer/pile/diff-qwen_1.8B-qwen_104M/diff_scores.pt")
-    output_path = os.path.join(base_path, f"processed_data/pretrain/pile-diff_samp-qwen_1.8B-qwen_104M-r{ratio}/qwen-1025")
+    # one or more ratios, e.g. 0.25,0.5,0.75
+    ratios = sorted(float(r) for r in sys.argv[2].split(","))
+    # 0: only write the selection and the report
+    num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 8
 
-    os.makedirs(output_path, exist_ok=True)
+    score_path = os.path.join(base_path, f"results/lm_infer/pile/diff-qwen_1.8B-qwen_104M/diff_scores")
+    selection_path = os.path.join(base_path, f"results/lm_infer/pile/diff-qwen_1.8B-qwen_104M/selection")
 
     tokenizer = AutoTokenizer.from_pretrained(model_path)
 
     dtype = best_fitting_dtype(len(tokenizer))
     print("dtype: ", dtype)
 
-    scores = torch.load(score_path, map_location="cpu")
+    # the score store of compute_difference_scores.py
+    scores = ScoreStore(score_path)
     dataset = DistributedMMapIndexedDataset(data_path, "data")
 
     if len(scores) != len(dataset):
         print("Warning: len(scores) != len(dataset) ({} != {})".format(len(scores), len(dataset)))
 
-    sorted_scores, sorted_indices = torch.sort(scores, descending=True)
-
-    kept_indices = sorted_indices[:int(ratio * len(sorted_indices))]
-    kept_scores = sorted_scores[:int(ratio * len(sorted_indices))]
-
-    indices = torch.sort(kept_indices)[0]
-
-    builder = ChunkedDatasetBuilder(base_path, output_path, dtype)
-
-    for i, idx in enumerate(tqdm(indices)):
-        data = dataset[idx.item()]
-        if i == 0:
-            print(idx)
+    # the top ratios of the samples by score, all in the same passes over the scores. The
+    # selection of ratios[j] is np.flatnonzero(levels <= j) (data_utils.load_selection).
+    ks = [int(ratio * len(scores)) for ratio in ratios]
+    levels = selection_levels(scores, ks)
+    if scores.num_valid() < ks[-1]:
+        print("Warning: only {} of the {} samples are scored".format(scores.num_valid(), len(scores)))
+
+    os.makedirs(selection_path, exist_ok=True)
+    sizes, domains = get_sample_infos(data_path, dataset.max_state, os.path.join(selection_path, "log.txt"))
+    domain_names = {}
+    if domains is not None:
+        with open(os.path.join(base_path, "tools", "process_data", "domain_labels.json")) as f:
+            domain_names = {v: k for k, v in json.load(f).items()}
+    report = selection_report(ratios, levels[:len(sizes)], sizes[:len(levels)],
+                              None if domains is None else domains[:len(levels)], domain_names)
+    save_selection(selection_path, ratios, levels, report)
+    for ratio in ratios:
+        print("Ratio {}: {} samples, {} tokens ({:.4f})".format(
+            ratio, report[str(ratio)]["samples"], report[str(ratio)]["tokens"], report[str(ratio)]["token_fraction"]))
+    print("Selection saved to", selection_path)
+
+    if num_workers <= 0:
+        return
+
+    for j, ratio in enumerate(ratios):
+        indices = np.flatnonzero(levels <= j)
+        output_path = os.path.join(base_path, f"processed_data/pretrain/pile-diff_samp-qwen_1.8B-qwen_104M-r{ratio}/qwen-1025")
+        os.makedirs(output_path, exist_ok=True)
+
+        if len(indices) > 0:
+            data = dataset[int(indices[0])]
+            print(indices[0])
             print(data.astype(int))
             print(tokenizer.decode(data.astype(int)))
-        builder.add_np_item(data)
-    builder.finalize()
+
+        # the runs of consecutive samples are copied from the source shards, one process per output shard
+        shards = gather_samples(data_path, "data", indices, output_path, dtype, num_workers=num_workers)
+        print("Written {} samples, {} tokens to {} shards".format(
+            sum(x[1] for x in shards), sum(x[2] for x in shards), len(shards)))
     
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
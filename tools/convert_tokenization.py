@@ -1,53 +1,189 @@
 import os
+import sys
 import time
 import numpy as np
 import argparse
 import multiprocessing as mp
 
 from utils import BOS_MODELS, get_tokenizer
-from data_utils import ChunkedDatasetBuilder, best_fitting_dtype, DistributedMMapIndexedDataset
+from data_utils import ChunkedDatasetBuilder, best_fitting_dtype, DistributedMMapIndexedDataset, get_node_output_path, write_manifest
+from data_utils import TextSidecar, text_sidecar_exists, Telemetry, TokenTranslator, is_byte_level
+from data_utils import token_byte_lengths, align_tokens, encode_alignment
+from data_utils.indexed_dataset import MMapIndexedDataset
 from arguments import add_data_args, add_runtime_args, add_hp_args, add_model_args, add_peft_args
 
+# the sentence-end chunking of tokenize_pile.py, for --repack
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "process_data"))
+from tokenize_pile import Writer, get_ent_sent_infos, get_space_token_mask
+from get_end_sent_tokens import decode_vocab
+
 
 class Encoder(object): 
-    def __init__(self, args):
+    def __init__(self, args, use_text_sidecar=False, use_translator=False):
         self.args = args
         self.old_model_type = args.old_model_type
         self.old_model_path = args.old_model_path
         self.new_model_type = args.model_type
         self.new_model_path = args.model_path
+        self.use_text_sidecar = use_text_sidecar
+        # translate the old tokens without decoding them (checked by validate_translator)
+        self.use_translator = use_translator
 
     def initializer(self):
         Encoder.tokenizer_old = get_tokenizer(
             self.args, model_path=self.old_model_path, model_type=self.old_model_type)
         Encoder.tokenizer_new = get_tokenizer(
             self.args, model_path=self.new_model_path, model_type=self.new_model_type)
+        Encoder.dtype = best_fitting_dtype(Encoder.tokenizer_new.vocab_size)
+        # built once per worker, so that its span cache lives across the tasks
+        Encoder.translator = TokenTranslator(Encoder.tokenizer_old, Encoder.tokenizer_new) if self.use_translator else None
+        if self.args.alignment_sidecar:
+            Encoder.old_byte_lengths = token_byte_lengths(Encoder.tokenizer_old)
+            Encoder.new_byte_lengths = token_byte_lengths(Encoder.tokenizer_new)
+        # the input shard (and its text sidecar) currently open in this worker
+        Encoder.state, Encoder.shard, Encoder.sidecar = None, None, None
 
-    def encode(self, id_with_d):
-        did, d = id_with_d
-        d = d.astype(int)
-        eos_poses = np.where(d == Encoder.tokenizer_old.eos_token_id)[0]
-        start = 0
-        split_d = []
-        for p in eos_poses:
-            split_d.append(d[start:p])
-            start = p + 1
-        split_d.append(d[start:])
-        tokens = []
-        for _d in split_d:
-            _s = Encoder.tokenizer_old.decode(_d, skip_special_tokens=True)
-            _tokens = Encoder.tokenizer_new.encode(_s, add_special_tokens=False)
-            tokens.extend(_tokens)
-            tokens.append(Encoder.tokenizer_new.eos_token_id)
-        tokens.pop() # pop the last eos_token_id
+    def open_shard(self, state):
+        if state != Encoder.state:
+            path = os.path.join(self.args.data_dir, f"data_{state}")
+            Encoder.shard = MMapIndexedDataset(path, skip_warmup=True)
+            Encoder.sidecar = TextSidecar(path) if self.use_text_sidecar else None
+            Encoder.state = state
+
+    def encode(self, task):
+        # Convert the samples [start, end) of the input shard `state`, which the worker reads itself.
+        # The new tokens of all samples are returned in one concatenated buffer, sample i is
+        # buffer[offsets[i]:offsets[i+1]]. The text segments of a sample come from the text sidecar
+        # of tokenize_pile.py if it exists, otherwise they are translated or decoded from the old tokens.
+        state, start, end = task
+        # the time of each step, for the telemetry
+        stage_seconds = {}
+        st = time.time()
+        self.open_shard(state)
+        samples = Encoder.shard[start:end]
+        stage_seconds["read"] = time.time() - st
+
+        st = time.time()
+        if Encoder.sidecar is not None:
+            texts = [Encoder.sidecar[i] for i in range(start, end)]
+            segment_nums = [len(_texts) for _texts in texts]
+            texts = [_s for _texts in texts for _s in _texts]
+        else:
+            split_d, segment_nums = split_segments(samples, Encoder.tokenizer_old.eos_token_id)
+            if Encoder.translator is None:
+                texts = Encoder.tokenizer_old.batch_decode(split_d, skip_special_tokens=True)
+        stage_seconds["decode"] = time.time() - st
+
+        st = time.time()
+        if Encoder.sidecar is None and Encoder.translator is not None:
+            new_tokens, segment_offsets = Encoder.translator.translate(split_d)
+            segment_tokens = [new_tokens[segment_offsets[i]:segment_offsets[i+1]] for i in range(len(split_d))]
+        else:
+            segment_tokens = Encoder.tokenizer_new(texts, add_special_tokens=False)["input_ids"]
+        all_tokens, all_alignments, k = [], [], 0
+        # the numbers of tokens kept and dropped by truncation
+        trunc_token_num, dropped_token_num = 0, 0
+        for segment_num in segment_nums:
+            tokens = []
+            for _tokens in segment_tokens[k:k+segment_num]:
+                tokens.extend(_tokens)
+                tokens.append(Encoder.tokenizer_new.eos_token_id)
+            tokens.pop() # pop the last eos_token_id
+            trunc_tokens = self.truncate(tokens)
+            if self.args.alignment_sidecar:
+                all_alignments.append(self.align(samples[len(all_tokens)], segment_tokens[k:k+segment_num], len(trunc_tokens)))
+            k += segment_num
+            trunc_token_num += len(trunc_tokens)
+            dropped_token_num += max(len(tokens) - self.args.max_length + (self.args.model_type in BOS_MODELS), 0)
+            if self.args.repack:
+                # the whole sample, ending with eos to separate it from the next one in the repacked chunks
+                if len(tokens) == 0 or tokens[-1] != Encoder.tokenizer_new.eos_token_id:
+                    tokens.append(Encoder.tokenizer_new.eos_token_id)
+                all_tokens.append(np.array(tokens, dtype=Encoder.dtype))
+            else:
+                all_tokens.append(np.array(trunc_tokens, dtype=Encoder.dtype))
+        offsets = np.zeros(len(all_tokens) + 1, dtype=np.int64)
+        np.cumsum([len(tokens) for tokens in all_tokens], out=offsets[1:])
+        stage_seconds["encode"] = time.time() - st
+        # the alignment of sample i is alignments[2 * offsets[i]:2 * offsets[i+1]]
+        alignments = np.concatenate(all_alignments) if self.args.alignment_sidecar else None
+
+        processed_bytes = sum(len(d) for d in samples)
+        return np.concatenate(all_tokens), offsets, processed_bytes, stage_seconds, trunc_token_num, dropped_token_num, alignments
+
+    def truncate(self, tokens):
         if self.args.model_type in BOS_MODELS:
             tokens = [Encoder.tokenizer_new.bos_token_id] + tokens[:self.args.max_length-1]
         else:
             tokens = tokens[:self.args.max_length]
             if len(tokens) <= 1:
                 tokens.append(Encoder.tokenizer_new.eos_token_id)
+        return tokens
+
+    def align(self, sample, segment_tokens, trunc_length):
+        # the encoded old token spans of the truncated new tokens of a sample (data_utils.token_alignment)
+        old_starts, old_ends = align_tokens(sample, Encoder.old_byte_lengths, Encoder.tokenizer_old.eos_token_id,
+                                            segment_tokens, Encoder.new_byte_lengths)
+        if self.args.model_type in BOS_MODELS:
+            # the new bos is aligned to the old one if there is one
+            bos_end = int(len(sample) > 0 and sample[0] == Encoder.tokenizer_old.bos_token_id)
+            old_starts = np.concatenate([[0], old_starts[:trunc_length-1]])
+            old_ends = np.concatenate([[bos_end], old_ends[:trunc_length-1]])
+        else:
+            old_starts, old_ends = old_starts[:trunc_length], old_ends[:trunc_length]
+            # the appended eos of a short sample is aligned to nothing
+            pad = [old_ends[-1] if len(old_ends) > 0 else 0] * (trunc_length - len(old_ends))
+            old_starts, old_ends = np.append(old_starts, pad).astype(np.int64), np.append(old_ends, pad).astype(np.int64)
+        return encode_alignment(old_starts, old_ends)
+
+
+def split_segments(samples, eos_token_id):
+    # the pieces of the samples between the eos tokens, and the number of pieces of each sample
+    split_d, segment_nums = [], []
+    for d in samples:
+        d = d.astype(int)
+        eos_poses = np.where(d == eos_token_id)[0]
+        # the pieces after the first one start with the eos token
+        split_d.extend(_d if k == 0 else _d[1:] for k, _d in enumerate(np.split(d, eos_poses)))
+        segment_nums.append(len(eos_poses) + 1)
+    return split_d, segment_nums
 
-        return did, d, tokens, len(d)
+
+def validate_translator(translator, data, num_samples, output_dir):
+    # compare the token translation with decoding and encoding on the first samples, and report the speedup
+    samples = [np.array(data[i]) for i in range(min(num_samples, len(data)))]
+    split_d, _ = split_segments(samples, translator.tokenizer_old.eos_token_id)
+    st = time.time()
+    slow_tokens, slow_offsets = translator.slow_translate(split_d)
+    slow_time = time.time() - st
+    st = time.time()
+    new_tokens, offsets = translator.translate(split_d)
+    fast_time = time.time() - st
+    # the second pass runs with the cache of the first one, as in a long conversion
+    st = time.time()
+    translator.translate(split_d)
+    cached_time = time.time() - st
+    identical = np.array_equal(new_tokens, slow_tokens) and np.array_equal(offsets, slow_offsets)
+    num_diff = sum(not np.array_equal(new_tokens[offsets[i]:offsets[i+1]], slow_tokens[slow_offsets[i]:slow_offsets[i+1]]) for i in range(len(split_d)))
+    stats = translator.stats()
+    print_and_save(f"Token translation on {len(samples)} samples ({len(split_d)} segments): " +
+                   f"{'identical' if identical else f'{num_diff} segments differ'} to decode + encode. " +
+                   f"decode + encode: {slow_time:.4f}s, translation: {fast_time:.4f}s ({slow_time / max(fast_time, 1e-9):.2f}x), " +
+                   f"with warm cache: {cached_time:.4f}s ({slow_time / max(cached_time, 1e-9):.2f}x). " +
+                   f"Old tokens from the table: {stats['table_fraction']:.4f}, from the cache: {stats['cached_fraction']:.4f}.", output_dir)
+    return identical
+
+
+def get_tasks(data, task_size):
+    # (state, start, end) sample ranges of at most task_size samples within one input shard,
+    # covering the samples of data in order
+    tasks = []
+    st, ed = data.min_offset, data.min_offset + len(data)
+    for state in range(data.min_state, data.max_state):
+        shard_st, shard_ed = data.history[state]
+        for i in range(max(st, shard_st), min(ed, shard_ed), task_size):
+            tasks.append((state, i - shard_st, min(i + task_size, ed, shard_ed) - shard_st))
+    return tasks
 
 
 def print_and_save(s, output_path):
@@ -59,6 +195,15 @@ def print_and_save(s, output_path):
 def get_additional_args(parser):
     parser.add_argument("--old-model-type", type=str, default=None)
     parser.add_argument("--old-model-path", type=str, default=None)
+    parser.add_argument("--token-translation", action="store_true",
+                        help="Translate the old tokens with a token table and cached spans instead of decoding and encoding all text.")
+    parser.add_argument("--token-translation-check-samples", type=int, default=1000,
+                        help="Number of samples on which the token translation is checked against decode + encode.")
+    parser.add_argument("--alignment-sidecar", action="store_true",
+                        help="Also write align_*.bin/.idx: for each new token of a sample, the span of old tokens it covers.")
+    parser.add_argument("--repack", action="store_true",
+                        help="Repack the converted samples into max-length chunks broken at sentence ends, "
+                             "instead of truncating each sample.")
     return parser
 
 
@@ -74,27 +219,80 @@ def get_args():
 
 def main():
     args = get_args()
-        
-    sid = args.min_state * args.chunk_num_per_shard + args.min_offset
+
+    if args.data_n_nodes > 1:
+        # split the input shards over the nodes, each node writes its shards from 0 in its own directory
+        assert args.min_offset == 0, "--min-offset is not supported with multiple nodes"
+        max_state = DistributedMMapIndexedDataset(args.data_dir, "data", min_state=args.min_state, max_state=args.max_state).max_state
+        num_states = max_state - args.min_state
+        min_state = args.min_state + num_states * args.data_node_rank // args.data_n_nodes
+        max_state = args.min_state + num_states * (args.data_node_rank + 1) // args.data_n_nodes
+        output_start_state = 0
+    else:
+        min_state, max_state, output_start_state = args.min_state, args.max_state, args.min_state
+
+    sid = min_state * args.chunk_num_per_shard + args.min_offset
 
     output_dir = os.path.join(args.save, args.data_name, f"{args.old_model_type}-{args.model_type}-{args.max_length}")
+    output_dir = get_node_output_path(output_dir, args.data_node_rank, args.data_n_nodes)
     os.makedirs(output_dir, exist_ok=True)
     
     cur_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
     print_and_save("\n\n" + "="*30 + f" EXP at {cur_time} " + "="*30, output_dir)
+    print_and_save(f"Node {args.data_node_rank}/{args.data_n_nodes}. Input states: [{min_state}, {max_state})", output_dir)
+
+    if max_state is not None and min_state >= max_state:
+        # more nodes than input shards
+        write_manifest(output_dir, start_state=output_start_state, node_rank=args.data_node_rank, n_nodes=args.data_n_nodes,
+                       inputs=[min_state, max_state])
+        return
 
     old_tokenizer = get_tokenizer(args, model_path=args.old_model_path, model_type=args.old_model_type)
     new_tokenizer = get_tokenizer(args, model_path=args.model_path, model_type=args.model_type)
 
     dtype = best_fitting_dtype(new_tokenizer.vocab_size)
+    telemetry = Telemetry(os.path.join(output_dir, "telemetry.jsonl"), args.telemetry_interval, args.data_process_workers)
     builder = ChunkedDatasetBuilder(
-        args.base_path, output_dir, dtype, output_state_start=args.min_state)
+        args.base_path, output_dir, dtype, output_start_state=output_start_state, telemetry=telemetry)
+    align_builder = None
+    if args.alignment_sidecar:
+        # the repacked chunks do not correspond to the old samples
+        assert not args.repack, "--alignment-sidecar is not supported with --repack"
+        # one alignment per sample, in the same shards as the samples
+        align_builder = ChunkedDatasetBuilder(
+            args.base_path, output_dir, np.uint16, split="align", output_start_state=output_start_state)
 
-    data = DistributedMMapIndexedDataset(args.data_dir, "data", min_state=args.min_state, min_offset=args.min_offset, max_state=args.max_state)
-    encoder = Encoder(args)
+    # only the index is used in the main process, the workers read the samples from the shards
+    data = DistributedMMapIndexedDataset(args.data_dir, "data", min_state=min_state, min_offset=args.min_offset, max_state=max_state)
+    use_text_sidecar = all(text_sidecar_exists(os.path.join(args.data_dir, f"data_{state}")) for state in range(min_state, data.max_state))
+    print_and_save(f"Text sidecar: {'found, encoding the raw text' if use_text_sidecar else 'not found, decoding the old tokens'}", output_dir)
+    use_translator = False
+    if args.token_translation and not use_text_sidecar:
+        if is_byte_level(old_tokenizer) and is_byte_level(new_tokenizer):
+            # the workers build their own translator, this one is only for the check
+            use_translator = validate_translator(TokenTranslator(old_tokenizer, new_tokenizer), data,
+                                                 args.token_translation_check_samples, output_dir)
+            if not use_translator:
+                print_and_save("Token translation differs from decode + encode, falling back to decode + encode.", output_dir)
+        else:
+            print_and_save("Token translation requires byte-level BPE tokenizers, falling back to decode + encode.", output_dir)
+    encoder = Encoder(args, use_text_sidecar, use_translator)
     pool = mp.Pool(processes=args.data_process_workers,
                    initializer=encoder.initializer)
-    encoded_docs = pool.imap(encoder.encode, enumerate(data), chunksize=50)
+    tasks = get_tasks(data, args.encode_batch_size)
+    # telemetry stages: worker/* (read, decode, encode in the pool workers), wait_encode (the main
+    # process waiting for them), and write
+    encoded_batches = telemetry.timed(pool.imap(encoder.encode, tasks), "wait_encode", nbytes=lambda x: int(x[0].nbytes))
+
+    if args.repack:
+        # chunk the stream of the converted samples like tokenize_pile.py, the leftover tokens of a
+        # sample go to the next chunk
+        vocab_tokens = decode_vocab(new_tokenizer)
+        end_sent_mask, rt_token_mask = get_ent_sent_infos(args, new_tokenizer, vocab_tokens)
+        space_mask = get_space_token_mask(new_tokenizer, vocab_tokens)
+        # the repacked chunks have no domain label
+        writer = Writer(args, output_dir, new_tokenizer, builder, None, end_sent_mask, rt_token_mask, dtype, space_mask=space_mask)
+    total_trunc_token_num, total_dropped_token_num = 0, 0
 
     proc_start = time.time()
     total_bytes_processed = 0
@@ -103,45 +301,78 @@ def main():
     min_length_no_trunc = 1000000
     mean_length = 0
 
-    for lid, (did, old_tokens, tokens, processed_bytes) in enumerate(encoded_docs):
-        max_length_no_trunc = max(max_length_no_trunc, len(tokens))
-        min_length_no_trunc = min(min_length_no_trunc, len(tokens))
+    lid = 0
+    for buffer, offsets, processed_bytes, stage_seconds, trunc_token_num, dropped_token_num, alignments in encoded_batches:
+        for stage, seconds in stage_seconds.items():
+            telemetry.add("worker/" + stage, seconds, count=len(offsets) - 1)
+        lengths = offsets[1:] - offsets[:-1]
+        max_length_no_trunc = max(max_length_no_trunc, int(np.max(lengths)))
+        min_length_no_trunc = min(min_length_no_trunc, int(np.min(lengths)))
+        assert args.repack or max_length_no_trunc <= args.max_length
+        total_trunc_token_num += trunc_token_num
+        total_dropped_token_num += dropped_token_num
 
         if lid == 0:
+            old_tokens, tokens = data[0], buffer[offsets[0]:offsets[1]]
             print("#### Original tokens: ####")
             print(old_tokens, len(old_tokens))
             print(old_tokenizer.decode(old_tokens))
             print("#### New tokens: ####")
             print(tokens, len(tokens))
             print(new_tokenizer.decode(tokens))
-        
-        mean_length += len(tokens)
+
+        mean_length += int(np.sum(lengths))
         total_bytes_processed += processed_bytes
-        
-        assert len(tokens) <= args.max_length
-        
-        sid += 1
-        builder.add_np_item(np.array(tokens, dtype=dtype))
 
-        if sid % 10000 == 0:
-            current = time.time()
-            elapsed = current - proc_start
-            mbs = total_bytes_processed / elapsed / 1024 / 1024
-            print_and_save(f"Processed {sid} documents. " + 
-                f"({lid/elapsed} docs/s, {mbs} MB/s).", output_dir)
+        for j in range(len(lengths)):
+            sid += 1
+            lid += 1
+            if args.repack:
+                writer.add_tokens(buffer[offsets[j]:offsets[j+1]], lid)
+            else:
+                builder.add_np_item(buffer[offsets[j]:offsets[j+1]])
+                if align_builder is not None:
+                    align_builder.add_np_item(alignments[2*offsets[j]:2*offsets[j+1]])
+
+            if sid % 10000 == 0:
+                current = time.time()
+                elapsed = current - proc_start
+                mbs = total_bytes_processed / elapsed / 1024 / 1024
+                print_and_save(f"Processed {sid} documents. " + 
+                    f"({lid/elapsed} docs/s, {mbs} MB/s).", output_dir)
+        telemetry.step(docs=lid, shards=builder.ofid - output_start_state)
 
     builder.finalize()
+    if align_builder is not None:
+        align_builder.finalize()
+    telemetry.flush(docs=lid, shards=builder.ofid - output_start_state)
+    write_manifest(output_dir, start_state=output_start_state, node_rank=args.data_node_rank, n_nodes=args.data_n_nodes,
+                   inputs=[min_state, data.max_state])
 
     pool.terminate()
     pool.close()
     pool.join()
     pool = None
     
-    mean_length = mean_length / sid
+    mean_length = mean_length / max(lid, 1)
     print_and_save(
         f"max_length_no_trunc: {max_length_no_trunc}, " + 
         f"min_length_no_trunc: {min_length_no_trunc}, " +
         f"mean_length: {mean_length}", output_dir)
+
+    # the padding of truncated samples, and of the repacked chunks
+    trunc_padding_fraction = 1 - total_trunc_token_num / max(lid * args.max_length, 1)
+    if args.repack:
+        # the repacked tokens include an eos between the samples
+        repack_token_num = writer.sid * args.max_length - writer.padded_token_num
+        print_and_save(
+            f"Repacked {lid} samples into {writer.sid} chunks. Tokens: {repack_token_num} " +
+            f"(truncation: {total_trunc_token_num}). Recovered {total_dropped_token_num} tokens dropped by truncation. " +
+            f"Padding fraction: {writer.padded_token_num / max(writer.sid * args.max_length, 1):.4f} " +
+            f"(truncation: {trunc_padding_fraction:.4f}).", output_dir)
+    else:
+        print_and_save(f"Tokens: {total_trunc_token_num}. Dropped by truncation: {total_dropped_token_num}. " +
+                       f"Padding fraction: {trunc_padding_fraction:.4f}.", output_dir)
         
 
 if __name__ == "__main__":
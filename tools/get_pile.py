@@ -1,29 +1,16 @@
-import datasets
 import os
-from tqdm import tqdm
-import json
+from huggingface_hub import snapshot_download
 
 
-data = datasets.load_dataset("monology/pile-uncopyrighted")
-print(data)
-
+# Download the compressed .jsonl.zst shards as they are. tools/process_data/tokenize_pile.py
+# decompresses them on the fly, so no uncompressed copy is written.
 output_dir = "data/pile/"
 os.makedirs(output_dir, exist_ok=True)
 
-max_num_per_shard = 1000000
-ofid = 0
-did = 0
+snapshot_download(
+    repo_id="monology/pile-uncopyrighted",
+    repo_type="dataset",
+    allow_patterns=["train/*.jsonl.zst"],
+    local_dir=output_dir)
 
-for split in ["train"]:
-    os.makedirs(os.path.join(output_dir, split), exist_ok=True)
-    f = open(os.path.join(output_dir, split, f"{ofid}.jsonl"), "w")
-    for d in tqdm(data[split]):
-        f.write(json.dumps(d) + "\n")
-        did += 1
-        if did >= max_num_per_shard:
-            f.close()
-            ofid += 1
-            did = 0
-            f = open(os.path.join(output_dir, split, f"{ofid}.jsonl"), "w")
-    
-    f.close()
\ No newline at end of file
+print(sorted(os.listdir(os.path.join(output_dir, "train"))))
@@ -0,0 +1,145 @@
+import os
+import shutil
+import sqlite3
+import hashlib
+import numpy as np
+
+from data_utils import mix64
+
+
+# Exact and near-duplicate (MinHash + LSH) detection of tokenized documents.
+# The keys are computed in the tokenization workers with `compute_dedup_keys`. The main process
+# decides in the document order with `Deduplicator`, the first occurrence is kept.
+
+
+def exact_hash(tokens):
+    return int.from_bytes(hashlib.blake2b(tokens.tobytes(), digest_size=8).digest(), "little")
+
+
+def minhash_signature(tokens, seeds, ngram, block_size=8192):
+    # min over the token n-gram shingles of num_perm seeded hashes
+    tokens = tokens.astype(np.uint64)
+    num_shingles = max(len(tokens) - ngram + 1, 1)
+    shingles = np.zeros(num_shingles, dtype=np.uint64)
+    for k in range(min(ngram, len(tokens))):
+        shingles = mix64(shingles ^ tokens[k:k+num_shingles])
+    shingles = np.unique(shingles)
+    signature = np.full(len(seeds), np.iinfo(np.uint64).max, dtype=np.uint64)
+    for st in range(0, len(shingles), block_size):
+        hashes = mix64(shingles[None, st:st+block_size] ^ seeds[:, None])
+        signature = np.minimum(signature, hashes.min(axis=1))
+    return signature
+
+
+def get_minhash_seeds(num_perm, seed=233):
+    return mix64(np.arange(num_perm, dtype=np.uint64) + np.uint64(seed))
+
+
+def compute_dedup_keys(tokens, seeds, bands, ngram):
+    # [exact hash, band key 0, ..., band key bands-1] of a document as int64 (sqlite integers)
+    signature = minhash_signature(tokens, seeds, ngram).reshape(bands, -1)
+    # different bands never share keys
+    band_keys = mix64(np.arange(bands, dtype=np.uint64) + np.uint64(len(seeds)))
+    for r in range(signature.shape[1]):
+        band_keys = mix64(band_keys ^ signature[:, r])
+    keys = np.concatenate([np.array([exact_hash(tokens)], dtype=np.uint64), band_keys])
+    return keys.view(np.int64)
+
+
+class DedupStore():
+    # A set of int64 keys in num_shards sqlite files (key % num_shards), so it is not bounded by RAM
+    def __init__(self, path, num_shards):
+        self.num_shards = num_shards
+        os.makedirs(path, exist_ok=True)
+        self.conns = []
+        for i in range(num_shards):
+            conn = sqlite3.connect(os.path.join(path, f"keys_{i}.sqlite"))
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE IF NOT EXISTS keys (k INTEGER PRIMARY KEY) WITHOUT ROWID")
+            self.conns.append(conn)
+
+    def _group(self, keys):
+        keys = np.unique(keys)
+        shards = keys % self.num_shards
+        return [(self.conns[i], keys[shards == i].tolist()) for i in range(self.num_shards)]
+
+    def contains(self, keys, max_params=900):
+        # the subset of keys in the store
+        found = set()
+        for conn, shard_keys in self._group(keys):
+            for st in range(0, len(shard_keys), max_params):
+                part = shard_keys[st:st+max_params]
+                query = f"SELECT k FROM keys WHERE k IN ({','.join(['?'] * len(part))})"
+                found.update(x[0] for x in conn.execute(query, part))
+        return found
+
+    def add(self, keys):
+        for conn, shard_keys in self._group(keys):
+            conn.executemany("INSERT OR IGNORE INTO keys VALUES (?)", [(k,) for k in shard_keys])
+            conn.commit()
+
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+
+
+class Deduplicator():
+    def __init__(self, path, num_shards):
+        # the store belongs to one run
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        self.store = DedupStore(path, num_shards)
+        self.stats = {}
+
+    def _domain_stats(self, label):
+        if label not in self.stats:
+            self.stats[label] = {"docs": 0, "tokens": 0, "exact_dup_docs": 0, "near_dup_docs": 0, "removed_tokens": 0}
+        return self.stats[label]
+
+    def filter(self, labels, offsets, keys):
+        # keys: (num_docs, 1 + bands) from compute_dedup_keys, returns the mask of the documents to keep
+        seen = self.store.contains(keys.reshape(-1))
+        keep = np.zeros(len(labels), dtype=bool)
+        new_keys = []
+        for j, label in enumerate(labels):
+            stats = self._domain_stats(label)
+            num_tokens = int(offsets[j+1] - offsets[j])
+            stats["docs"] += 1
+            stats["tokens"] += num_tokens
+            doc_keys = keys[j].tolist()
+            if doc_keys[0] in seen:
+                stats["exact_dup_docs"] += 1
+                stats["removed_tokens"] += num_tokens
+            elif any(k in seen for k in doc_keys[1:]):
+                stats["near_dup_docs"] += 1
+                stats["removed_tokens"] += num_tokens
+            else:
+                keep[j] = True
+                seen.update(doc_keys)
+                new_keys.extend(doc_keys)
+        self.store.add(np.array(new_keys, dtype=np.int64))
+        return keep
+
+    def report(self):
+        total = {"docs": 0, "tokens": 0, "exact_dup_docs": 0, "near_dup_docs": 0, "removed_tokens": 0}
+        for stats in self.stats.values():
+            for k in total:
+                total[k] += stats[k]
+        report = {"domains": self.stats, "total": total}
+        for stats in list(self.stats.values()) + [total]:
+            stats["removed_token_fraction"] = stats["removed_tokens"] / max(stats["tokens"], 1)
+        return report
+
+    def close(self):
+        self.store.close()
+
+
+def select_docs(buffer, offsets, labels, doc_lens, keep):
+    # the batch restricted to the documents in keep
+    sel = np.flatnonzero(keep)
+    lengths = offsets[sel+1] - offsets[sel]
+    new_offsets = np.zeros(len(sel) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    new_buffer = np.concatenate([buffer[offsets[j]:offsets[j+1]] for j in sel] + [buffer[:0]])
+    return new_buffer, new_offsets, [labels[j] for j in sel], doc_lens[sel]
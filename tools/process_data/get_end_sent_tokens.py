@@ -1,52 +1,70 @@
-from transformers import AutoTokenizer
+import os
 import json
-from tqdm import tqdm
+import argparse
+from transformers import AutoTokenizer
+
+from data_utils.tokenized_cache import tokenizer_fingerprint
 
 # characters that will appear at the end of a sentence
 ent_sent_chars = ".!?;\n"
-branket_chars = ["[]", "()", "\{\}", "<>"]
-# name = "fairseq"
-# tokenizer = AutoTokenizer.from_pretrained("checkpoints/fairseq/125M/")
-
-# name = "mistral"
-# tokenizer = AutoTokenizer.from_pretrained("checkpoints/mistral/125M/")
-
-# name = "gpt2"
-# tokenizer = AutoTokenizer.from_pretrained("checkpoints/gpt2/base/")
-
-# name = "llama3_1"
-# tokenizer = AutoTokenizer.from_pretrained("checkpoints/llama3.1-8B/")
-
-# name = "qwen"
-# tokenizer = AutoTokenizer.from_pretrained("checkpoints/qwen/")
-
-name = "mamba"
-tokenizer = AutoTokenizer.from_pretrained("checkpoints/mamba/falcon-7B")
-
-white_list = [
-    
-]
-
-print(len(tokenizer))
-
-ent_sent_tokens = []
-for i in tqdm(range(len(tokenizer))):
-    for ent_sent_char in ent_sent_chars:
-        token = tokenizer.decode([i])
-        if ent_sent_char in token:
-            valid = True
-            for bracket_char in branket_chars:
-                if (bracket_char[0] in token) and (bracket_char[1] not in token):
-                    valid = False
-                    break
-            if valid:
-                ent_sent_tokens.append(i)
-                break
-
-ent_sent_tokens.append(tokenizer.eos_token_id)
-
-with open(f"tools/process_data/end_sent_token_{name}.json", "w") as f:
-    json.dump(ent_sent_tokens, f, indent=4)
-    
-for ent_sent_token in ent_sent_tokens:
-    print(tokenizer.convert_ids_to_tokens(ent_sent_token), ent_sent_token)
+# NOTE: "\\{\\}" (rather than "{}") is kept so that the tables match the released end_sent_token_*.json
+branket_chars = ["[]", "()", "\\{\\}", "<>"]
+
+
+def decode_vocab(tokenizer):
+    # the decoded string of every token id
+    return tokenizer.batch_decode([[i] for i in range(len(tokenizer))])
+
+
+def compute_end_sent_tokens(tokenizer, vocab_tokens=None):
+    # tokens that contain an end-of-sentence character and no unclosed bracket, and the eos token
+    if vocab_tokens is None:
+        vocab_tokens = decode_vocab(tokenizer)
+    ent_sent_tokens = []
+    for i, token in enumerate(vocab_tokens):
+        if not any(c in token for c in ent_sent_chars):
+            continue
+        if any((bracket_char[0] in token) and (bracket_char[1] not in token) for bracket_char in branket_chars):
+            continue
+        ent_sent_tokens.append(i)
+    ent_sent_tokens.append(tokenizer.eos_token_id)
+    return ent_sent_tokens
+
+
+def load_end_sent_tokens(base_path, model_type, tokenizer, vocab_tokens=None):
+    # Use the released table of model_type if it exists. Otherwise, the table is computed and
+    # cached under the fingerprint of the tokenizer.
+    path = os.path.join(base_path, "tools", "process_data", f"end_sent_token_{model_type}.json")
+    if not os.path.exists(path):
+        cache_dir = os.path.join(base_path, "tools", "process_data", "end_sent_token_cache")
+        path = os.path.join(cache_dir, f"{tokenizer_fingerprint(tokenizer)}.json")
+        if not os.path.exists(path):
+            print(f"Computing end-of-sentence tokens to {path}")
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(compute_end_sent_tokens(tokenizer, vocab_tokens), f, indent=4)
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--model-type", type=str, required=True)
+    parser.add_argument("--base-path", type=str, default=".")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    print(len(tokenizer))
+
+    ent_sent_tokens = compute_end_sent_tokens(tokenizer)
+
+    with open(os.path.join(args.base_path, "tools", "process_data", f"end_sent_token_{args.model_type}.json"), "w") as f:
+        json.dump(ent_sent_tokens, f, indent=4)
+
+    for ent_sent_token in ent_sent_tokens:
+        print(tokenizer.convert_ids_to_tokens(ent_sent_token), ent_sent_token)
+
+
+if __name__ == "__main__":
+    main()
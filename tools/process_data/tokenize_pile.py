@@ -5,12 +5,42 @@ import numpy as np
 import random
 import torch
 import time
+import io
+import gzip
+import queue
+import threading
+import itertools
+import collections
 import multiprocessing
 from utils import print_args, PAD_EOS_MODELS, BOS_MODELS
-from data_utils import ChunkedDatasetBuilder, best_fitting_dtype
+from data_utils import ChunkedDatasetBuilder, best_fitting_dtype, get_node_output_path, write_manifest, Telemetry
 from arguments import add_data_args, add_runtime_args, add_hp_args, add_model_args, add_peft_args
 import argparse
 from transformers import AutoTokenizer
+from get_end_sent_tokens import decode_vocab, load_end_sent_tokens
+from dedup import get_minhash_seeds, compute_dedup_keys, Deduplicator, select_docs
+
+try:
+    import orjson as fast_json
+except ImportError:
+    fast_json = json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# files that can not be split by bytes over the nodes
+COMPRESSED_SUFFIXES = (".gz", ".zst")
+COLUMNAR_SUFFIXES = (".arrow", ".parquet")
 
 
 random.seed(233)
@@ -31,18 +61,218 @@ class Encoder(object):
 
         if self.args.model_type in PAD_EOS_MODELS:
             Encoder.tokenizer.pad_token = Encoder.tokenizer.eos_token
+        Encoder.dtype = best_fitting_dtype(len(Encoder.tokenizer))
+        if self.args.dedup:
+            Encoder.minhash_seeds = get_minhash_seeds(self.args.dedup_num_perm)
+
+    def encode(self, batch):
+        # encode a batch of json lines or of {"text": [...], "label": [...]} from columnar files.
+        # The tokens of all documents (each followed by eos) are returned in one concatenated buffer,
+        # document i is buffer[offsets[i]:offsets[i+1]]. stage_seconds: the time of each step, for the telemetry
+        stage_seconds = {}
+        st = time.time()
+        if isinstance(batch, dict):
+            docs, labels = batch["text"], batch["label"]
+        else:
+            lines = [fast_json.loads(json_line) for json_line in batch]
+            docs = [line["text"] for line in lines]
+            labels = [line["meta"]["pile_set_name"] for line in lines]
+        doc_lens = np.array([len(doc) for doc in docs], dtype=np.int64)
+        stage_seconds["parse"] = time.time() - st
+
+        st = time.time()
+        if self.args.text_sidecar:
+            assert Encoder.tokenizer.is_fast, "--text-sidecar requires a fast tokenizer for the character offsets"
+        if Encoder.tokenizer.is_fast:
+            # the rust tokenizer encodes the batch with multiple threads
+            backend = Encoder.tokenizer.backend_tokenizer
+            # encode_batch_fast does not compute the offsets
+            encode_batch = backend.encode_batch if self.args.text_sidecar else getattr(backend, "encode_batch_fast", backend.encode_batch)
+            encodings = encode_batch(docs, add_special_tokens=False)
+            ids = [x.ids for x in encodings]
+        else:
+            ids = Encoder.tokenizer(docs, add_special_tokens=False)["input_ids"]
+
+        lengths = np.array([len(x) for x in ids], dtype=np.int64)
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(lengths + 1, out=offsets[1:])
+        buffer = np.full(offsets[-1], Encoder.tokenizer.eos_token_id, dtype=Encoder.dtype)
+        is_token = np.ones(offsets[-1], dtype=bool)
+        is_token[offsets[1:] - 1] = False
+        buffer[is_token] = np.fromiter(itertools.chain.from_iterable(ids), dtype=Encoder.dtype, count=int(np.sum(lengths)))
+        stage_seconds["tokenize"] = time.time() - st
+
+        if self.args.dedup:
+            st = time.time()
+            # the keys of the documents without the eos token
+            dedup_keys = np.zeros((len(ids), 1 + self.args.dedup_bands), dtype=np.int64)
+            for j in range(len(ids)):
+                dedup_keys[j] = compute_dedup_keys(buffer[offsets[j]:offsets[j+1]-1], Encoder.minhash_seeds,
+                                                   self.args.dedup_bands, self.args.dedup_ngram)
+            stage_seconds["dedup_keys"] = time.time() - st
+        else:
+            dedup_keys = None
+
+        if self.args.text_sidecar:
+            st = time.time()
+            # the character span of each token in its document, aligned with buffer. The spans of a
+            # document cover its text without gaps, so the text of any token range can be sliced out.
+            char_spans = np.zeros((offsets[-1], 2), dtype=np.int64)
+            for j, (encoding, doc) in enumerate(zip(encodings, docs)):
+                ends = np.array([end for _, end in encoding.offsets] + [len(doc)], dtype=np.int64)
+                ends = np.minimum(np.maximum.accumulate(ends), len(doc))
+                # the last token also takes the trailing characters, the eos token is empty
+                if len(ends) > 1:
+                    ends[-2] = len(doc)
+                char_spans[offsets[j]:offsets[j+1], 0] = np.concatenate([[0], ends[:-1]])
+                char_spans[offsets[j]:offsets[j+1], 1] = ends
+            stage_seconds["char_spans"] = time.time() - st
+        else:
+            docs, char_spans = None, None
+
+        return buffer, offsets, labels, doc_lens, dedup_keys, docs, char_spans, stage_seconds
+
+
+def batch_bytes(batch):
+    # the input size of a batch: bytes of json lines, characters of columnar texts
+    if isinstance(batch, dict):
+        return sum(len(text) for text in batch["text"])
+    return sum(len(line) for line in batch)
+
+
+def read_line_batches(lines, batch_size):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def get_byte_ranges(paths, node_rank, n_nodes):
+    # Split the concatenation of the files into n_nodes contiguous byte ranges and return the
+    # (path, start, end) pieces of this node. A line belongs to the node where it starts.
+    # Compressed and columnar files are not split, they belong to the node where they start.
+    sizes = [os.path.getsize(path) for path in paths]
+    total = sum(sizes)
+    node_start, node_end = total * node_rank // n_nodes, total * (node_rank + 1) // n_nodes
+    ranges = []
+    offset = 0
+    for path, size in zip(paths, sizes):
+        if path.endswith(COMPRESSED_SUFFIXES + COLUMNAR_SUFFIXES):
+            if node_start <= offset < node_end:
+                ranges.append((path, 0, size))
+        else:
+            start, end = max(node_start - offset, 0), min(node_end - offset, size)
+            if start < end:
+                ranges.append((path, start, end))
+        offset += size
+    return ranges
+
+
+def open_jsonl(path):
+    # a binary line reader of (compressed) jsonl files, decompressing on the fly
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    elif path.endswith(".zst"):
+        assert zstandard is not None, "Reading .zst files requires zstandard: pip install zstandard"
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+    else:
+        return open(path, "rb")
+
 
-    def encode(self, id_with_json_line):
-        doc_id, json_line = id_with_json_line
-        line = json.loads(json_line)
-        doc = line["text"]
-        label = line["meta"]["pile_set_name"]
-        tokens = Encoder.tokenizer.encode(
-            doc, add_special_tokens=False) + [Encoder.tokenizer.eos_token_id]
-        # del doc
-        # del line
+def read_columnar_batches(path, batch_size):
+    # {"text": [...], "label": [...]} batches of a parquet file or an arrow file (e.g. a datasets cache file)
+    assert pyarrow is not None, "Reading arrow/parquet files requires pyarrow: pip install pyarrow"
+    if path.endswith(".parquet"):
+        record_batches = pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=batch_size, columns=["text", "meta"])
+    else:
+        source = pyarrow.memory_map(path)
+        try:
+            reader = pyarrow.ipc.open_file(source)
+            record_batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        except pyarrow.ArrowInvalid:
+            # datasets writes arrow files in the streaming format
+            record_batches = pyarrow.ipc.open_stream(pyarrow.memory_map(path))
+    for record_batch in record_batches:
+        texts = record_batch.column("text").to_pylist()
+        labels = record_batch.column("meta").field("pile_set_name").to_pylist()
+        for i in range(0, len(texts), batch_size):
+            yield {"text": texts[i:i+batch_size], "label": labels[i:i+batch_size]}
+
+
+def read_line_range(fin, start, end):
+    # the lines starting in [start, end), the last one may end after end
+    if start > 0:
+        # skip the rest of the line containing start - 1, it belongs to the previous range
+        fin.seek(start - 1)
+        fin.readline()
+    pos = fin.tell()
+    while pos < end:
+        line = fin.readline()
+        if not line:
+            break
+        yield line
+        pos += len(line)
 
-        return tokens, doc_id, label, len(doc)
+
+def read_file_batches(args, ranges, output_path):
+    # the batches of all byte ranges, in order
+    for fid, (path, start, end) in enumerate(ranges):
+        print_and_save(f"Processing {os.path.basename(path)} [{start}, {end}). {fid}/{len(ranges)}", output_path)
+        if path.endswith(COLUMNAR_SUFFIXES):
+            for batch in read_columnar_batches(path, args.encode_batch_size):
+                yield batch
+        else:
+            with open_jsonl(path) as fin:
+                lines = fin if path.endswith(COMPRESSED_SUFFIXES) else read_line_range(fin, start, end)
+                for batch in read_line_batches(lines, args.encode_batch_size):
+                    yield batch
+
+
+def background_iterator(items, max_size, telemetry=None):
+    # iterate items in a background thread, so that reading and decompressing the input
+    # overlaps with the main process work
+    q = queue.Queue(max_size)
+    end = object()
+
+    def produce():
+        try:
+            for item in items:
+                q.put(item)
+            q.put(end)
+        except BaseException as e:
+            q.put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        if telemetry is not None:
+            telemetry.gauge("read_queue", q.qsize())
+        item = q.get()
+        if item is end:
+            break
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def ordered_imap(pool, func, items, max_pending, telemetry=None):
+    # Like pool.imap, but reads at most max_pending items ahead of the consumer. The results
+    # are yielded in the submission order: a finished result waits in the queue until all the
+    # earlier ones are consumed.
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if telemetry is not None:
+            # results in flight, and those finished but waiting for an earlier one
+            telemetry.gauge("encode_pending", len(pending))
+            telemetry.gauge("encode_ready", sum(r.ready() for r in pending))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
 
 
 class Writer():
@@ -54,77 +284,329 @@ class Writer():
                  label_index,
                  end_sent_mask,
                  rt_token_mask,
-                 dtype):
+                 dtype,
+                 space_mask=None):
         self.args = args
         self.output_path = output_path
         self.tokenizer = tokenizer
         self.label = label_index
+        # the buffer of tokens not yet chunked is self.buffer[self.start:self.end].
+        # For BOS_MODELS, every chunk starts with bos_token_id, which is not stored in the buffer.
         if self.args.model_type in BOS_MODELS:
-            self.chunk_tokens_buffer = [tokenizer.bos_token_id]
+            self.prefix = np.array([tokenizer.bos_token_id], dtype=np.int64)
         else:
-            self.chunk_tokens_buffer = []
+            self.prefix = np.zeros(0, dtype=np.int64)
+        self.buffer = np.zeros(4 * self.args.max_length, dtype=np.int64)
+        self.start = 0
+        self.end = 0
+        # with text_sidecar, the character span and the document of each token in the buffer,
+        # and the texts of the documents in the buffer
+        self.text_sidecar = self.args.text_sidecar
+        if self.text_sidecar:
+            self.char_spans = np.zeros((len(self.buffer), 2), dtype=np.int64)
+            self.doc_ids = np.zeros(len(self.buffer), dtype=np.int64)
+            self.texts = collections.OrderedDict()
         self.end_sent_mask = end_sent_mask
         self.rt_token_mask = rt_token_mask
+        self.space_mask = space_mask
+        self.space_pair_cache = {}
         self.builder = builder
         self.sid = 0
         self.padded_token_num = 0
         self.dtype = dtype
     
-    def check_sent_end(self, tokenizer, i, new_chunk, chunk_tokens_buffer):
-        model_type = self.args.model_type
-        if model_type in BOS_MODELS:
-            tokens = (new_chunk+chunk_tokens_buffer[1:2])[i:i+2]
+    def check_sent_end(self, token, next_token):
+        # whether the decoded (token, next_token) pair contains a space
+        if next_token is None:
+            return True
+        if self.space_mask is not None:
+            return self.space_mask[token] or self.space_mask[next_token]
+        if (token, next_token) not in self.space_pair_cache:
+            s = self.tokenizer.decode([token, next_token])
+            self.space_pair_cache[(token, next_token)] = (" " in s)
+        return self.space_pair_cache[(token, next_token)]
+
+    def _move(self, buffer, size, n):
+        # buffer[self.start:self.end] moved to the front of a buffer of the given size
+        if size > len(buffer):
+            new_buffer = np.zeros((size,) + buffer.shape[1:], dtype=buffer.dtype)
         else:
-            tokens = (new_chunk+chunk_tokens_buffer[:1])[i:i+2]
-        s = tokenizer.decode(tokens)
-        return len(tokens) == 1 or (" " in s)
-    
-    def add_tokens(self, doc_tokens, lid):
-        self.chunk_tokens_buffer.extend(doc_tokens)
+            new_buffer = buffer
+        new_buffer[:n] = buffer[self.start:self.end]
+        return new_buffer
+
+    def _extend(self, doc_tokens, lid=0, text=None, char_spans=None):
+        doc_tokens = np.asarray(doc_tokens, dtype=np.int64)
+        n = self.end - self.start
+        if self.end + len(doc_tokens) > len(self.buffer):
+            if n + len(doc_tokens) > len(self.buffer) // 2:
+                size = 2 * (n + len(doc_tokens))
+            else:
+                size = len(self.buffer)
+            if self.text_sidecar:
+                self.char_spans = self._move(self.char_spans, size, n)
+                self.doc_ids = self._move(self.doc_ids, size, n)
+            self.buffer, self.start, self.end = self._move(self.buffer, size, n), 0, n
+        self.buffer[self.end:self.end+len(doc_tokens)] = doc_tokens
+        if self.text_sidecar:
+            self.char_spans[self.end:self.end+len(doc_tokens)] = char_spans
+            self.doc_ids[self.end:self.end+len(doc_tokens)] = lid
+            self.texts[lid] = text
+        self.end += len(doc_tokens)
+
+    def _chunk_texts(self, start, end):
+        # the texts of the pieces of buffer[start:end] between the eos tokens
+        eos_poses = start + np.flatnonzero(self.buffer[start:end] == self.tokenizer.eos_token_id)
+        starts = np.concatenate([[start], eos_poses + 1])
+        ends = np.concatenate([eos_poses, [end]])
+        return [self.texts[int(self.doc_ids[st])][self.char_spans[st, 0]:self.char_spans[ed-1, 1]] if st < ed else ""
+                for st, ed in zip(starts, ends)]
+
+    def _free_texts(self):
+        # the texts of the documents that have left the buffer
+        first_lid = self.doc_ids[self.start] if self.start < self.end else None
+        while len(self.texts) > 0 and (first_lid is None or next(iter(self.texts)) < first_lid):
+            self.texts.popitem(last=False)
+
+    def _find_chunk_end(self, new_chunk, next_token):
+        # the last position i in new_chunk that ends a sentence, -1 if not found
+        hard = (new_chunk == self.tokenizer.eos_token_id) | self.rt_token_mask[new_chunk]
+        candidates = np.flatnonzero(hard | self.end_sent_mask[new_chunk])
+        if self.space_mask is not None:
+            next_tokens = np.append(new_chunk[1:], next_token if next_token is not None else 0)
+            soft = self.space_mask[new_chunk] | self.space_mask[next_tokens]
+            if next_token is None:
+                soft[-1] = True
+            candidates = candidates[hard[candidates] | soft[candidates]]
+            return candidates[-1] if len(candidates) > 0 else -1
+        for i in candidates[::-1]:
+            # check if the end is fake
+            # 1. Who are you? I am the D.A. and he is //Bat Man. -> Who are you? // I am the D.A. and he is Bat Man.
+            # 2. Who are you? I am the D.//A. -> Who are you? // I am the D.A.
+            if hard[i] or self.check_sent_end(int(new_chunk[i]), int(new_chunk[i+1]) if i+1 < len(new_chunk) else next_token):
+                return i
+        return -1
+
+    def add_tokens(self, doc_tokens, lid, text=None, char_spans=None):
+        self._extend(doc_tokens, lid, text, char_spans)
+        max_length = self.args.max_length
+        content_length = max_length - len(self.prefix)
         n = 0
-        while len(self.chunk_tokens_buffer) >= self.args.max_length:
-            new_chunk = self.chunk_tokens_buffer[:self.args.max_length]
-            if self.args.model_type in BOS_MODELS:
-                self.chunk_tokens_buffer = [self.tokenizer.bos_token_id] + \
-                    self.chunk_tokens_buffer[self.args.max_length:]
+        while self.end - self.start >= content_length:
+            chunk_start = self.start
+            new_chunk = np.concatenate([self.prefix, self.buffer[self.start:self.start+content_length]])
+            rest_start = self.start + content_length
+            next_token = int(self.buffer[rest_start]) if rest_start < self.end else None
+            i = self._find_chunk_end(new_chunk, next_token)
+            if i >= 0:
+                # the tokens after i go back to the buffer
+                new_chunk = new_chunk[:i+1]
+                self.start += max(i + 1 - len(self.prefix), 0)
+                self.padded_token_num += max_length - (i+1)
             else:
-                self.chunk_tokens_buffer = self.chunk_tokens_buffer[self.args.max_length:]
-
-            for i in range(len(new_chunk)-1, -1, -1):
-                if (new_chunk[i] in [self.tokenizer.eos_token_id]) or \
-                    (self.rt_token_mask[new_chunk[i]]) or \
-                    (self.end_sent_mask[new_chunk[i]] and self.check_sent_end(self.tokenizer, i, new_chunk, self.chunk_tokens_buffer)): # check if the end is fake
-                    # 1. Who are you? I am the D.A. and he is //Bat Man. -> Who are you? // I am the D.A. and he is Bat Man.
-                    # 2. Who are you? I am the D.//A. -> Who are you? // I am the D.A.
-                    incomplete_sent = new_chunk[i+1:]
-                    # new_chunk = new_chunk[:i+1] + [tokenizer.pad_token_id] * (args.max_length - (i+1))
-                    new_chunk = new_chunk[:i+1]
-                    if self.args.model_type in BOS_MODELS:
-                        self.chunk_tokens_buffer = self.chunk_tokens_buffer[:1] + incomplete_sent + self.chunk_tokens_buffer[1:]
-                    else:
-                        self.chunk_tokens_buffer = incomplete_sent + self.chunk_tokens_buffer
-                    self.padded_token_num += self.args.max_length - (i+1)
+                self.start = rest_start
+            chunk_end = self.start
 
-                    break
-            
             if self.args.model_type in BOS_MODELS:
                 assert new_chunk[0] == self.tokenizer.bos_token_id
             if len(new_chunk) <= 1:
                 continue
-            assert len(new_chunk) <= self.args.max_length
+            assert len(new_chunk) <= max_length
             
             self.sid += 1
             n += 1
             if n > 500 and (n % 100 == 0):
                 print_and_save(f"Constructing {n} chunks from a document, chunk len: {len(new_chunk)}", self.output_path)
-                print_and_save(f"Chunk: {new_chunk}", self.output_path)
+                print_and_save(f"Chunk: {new_chunk.tolist()}", self.output_path)
             if n > 2000:
-                if self.args.model_type in BOS_MODELS:
-                    self.chunk_tokens_buffer = [self.tokenizer.bos_token_id]
-                else:
-                    self.chunk_tokens_buffer = []
+                self.start, self.end = 0, 0
                 break
-            self.builder.add_np_item(np.array(new_chunk, dtype=self.dtype))
+            if self.text_sidecar:
+                self.builder.add_np_item(np.array(new_chunk, dtype=self.dtype), texts=self._chunk_texts(chunk_start, chunk_end), label=self.label)
+            else:
+                self.builder.add_np_item(np.array(new_chunk, dtype=self.dtype), label=self.label)
+        if self.text_sidecar:
+            self._free_texts()
+
+
+class ChunkCollector():
+    # stands in for the builder of the Writers in a chunker process
+    def __init__(self):
+        self.chunks = []
+        self.texts = []
+        self.labels = []
+
+    def add_np_item(self, item, texts=None, label=None):
+        self.chunks.append(item)
+        self.texts.append(texts)
+        self.labels.append(label)
+
+
+class DomainChunker():
+    # chunks the documents of each domain with a separate Writer
+    def __init__(self,
+                 args,
+                 output_path,
+                 tokenizer,
+                 builder,
+                 domain_labels,
+                 end_sent_mask,
+                 rt_token_mask,
+                 dtype,
+                 space_mask=None):
+        self.args = args
+        self.output_path = output_path
+        self.tokenizer = tokenizer
+        self.builder = builder
+        self.domain_labels = domain_labels
+        self.end_sent_mask = end_sent_mask
+        self.rt_token_mask = rt_token_mask
+        self.dtype = dtype
+        self.space_mask = space_mask
+        self.writers = {}
+
+    def add_document(self, doc_tokens, label, lid, text=None, char_spans=None):
+        # returns the increments of sid and padded_token_num
+        if label not in self.writers:
+            self.writers[label] = Writer(self.args, self.output_path, self.tokenizer, self.builder, self.domain_labels[label],
+                                         self.end_sent_mask, self.rt_token_mask, self.dtype, space_mask=self.space_mask)
+        writer = self.writers[label]
+        sid, padded_token_num = writer.sid, writer.padded_token_num
+        writer.add_tokens(doc_tokens, lid, text, char_spans)
+        return writer.sid - sid, writer.padded_token_num - padded_token_num
+
+
+def chunker_process(chunker, in_queue, out_queue):
+    # chunker.builder is a ChunkCollector. For each batch, the finished chunks are sent back
+    # in one buffer, together with the lid of the document each chunk comes from.
+    while True:
+        item = in_queue.get()
+        if item is None:
+            break
+        st = time.time()
+        lids, labels, buffer, offsets, texts, char_spans = item
+        chunk_lids = []
+        sid, padded_token_num = 0, 0
+        for j in range(len(lids)):
+            n = len(chunker.builder.chunks)
+            if texts is not None:
+                d_sid, d_padded = chunker.add_document(buffer[offsets[j]:offsets[j+1]], labels[j], lids[j],
+                                                       texts[j], char_spans[offsets[j]:offsets[j+1]])
+            else:
+                d_sid, d_padded = chunker.add_document(buffer[offsets[j]:offsets[j+1]], labels[j], lids[j])
+            sid += d_sid
+            padded_token_num += d_padded
+            chunk_lids.extend([lids[j]] * (len(chunker.builder.chunks) - n))
+        chunks, chunk_texts, chunk_labels = chunker.builder.chunks, chunker.builder.texts, chunker.builder.labels
+        chunker.builder.chunks, chunker.builder.texts, chunker.builder.labels = [], [], []
+        lengths = np.array([len(x) for x in chunks], dtype=np.int64)
+        chunks = np.concatenate(chunks + [np.zeros(0, dtype=chunker.dtype)])
+        out_queue.put((np.array(chunk_lids, dtype=np.int64), chunks, lengths, chunk_texts, np.array(chunk_labels, dtype=np.int64),
+                       sid, padded_token_num, time.time() - st))
+
+
+class ChunkerPool():
+    # Domain-sharded chunker processes. All documents of a domain go to the same process in the
+    # input order, so the chunks are the same as chunking in the main process. The results of a
+    # batch are merged back in the document order.
+    def __init__(self, num_workers, chunker):
+        self.num_workers = num_workers
+        self.domain_labels = chunker.domain_labels
+        self.in_queues = [multiprocessing.Queue() for _ in range(num_workers)]
+        self.out_queues = [multiprocessing.Queue() for _ in range(num_workers)]
+        self.procs = [multiprocessing.Process(target=chunker_process, args=(chunker, self.in_queues[k], self.out_queues[k]), daemon=True)
+                      for k in range(num_workers)]
+        for proc in self.procs:
+            proc.start()
+        self.num_pending = 0
+
+    def submit(self, lids, labels, buffer, offsets, texts=None, char_spans=None):
+        shards = np.array([self.domain_labels[label] % self.num_workers for label in labels], dtype=np.int64)
+        for k in range(self.num_workers):
+            sel = np.flatnonzero(shards == k)
+            sub_offsets = np.zeros(len(sel) + 1, dtype=np.int64)
+            np.cumsum(offsets[sel+1] - offsets[sel], out=sub_offsets[1:])
+            sub_buffer = np.concatenate([buffer[offsets[j]:offsets[j+1]] for j in sel] + [buffer[:0]])
+            if texts is not None:
+                sub_texts = [texts[j] for j in sel]
+                sub_char_spans = np.concatenate([char_spans[offsets[j]:offsets[j+1]] for j in sel] + [char_spans[:0]])
+            else:
+                sub_texts, sub_char_spans = None, None
+            self.in_queues[k].put((lids[sel], [labels[j] for j in sel], sub_buffer, sub_offsets, sub_texts, sub_char_spans))
+        self.num_pending += 1
+
+    def get(self):
+        # the chunks of the earliest submitted batch, in the document order
+        chunk_lids, chunks, chunk_texts, chunk_labels = [], [], [], []
+        sid, padded_token_num = 0, 0
+        # the total busy seconds of the chunker processes on this batch
+        busy_seconds = 0.0
+        for q in self.out_queues:
+            _chunk_lids, buffer, lengths, _chunk_texts, _chunk_labels, _sid, _padded_token_num, _busy_seconds = q.get()
+            busy_seconds += _busy_seconds
+            offsets = np.concatenate([[0], np.cumsum(lengths)])
+            chunk_lids.append(_chunk_lids)
+            chunks.extend([buffer[offsets[i]:offsets[i+1]] for i in range(len(lengths))])
+            chunk_texts.extend(_chunk_texts)
+            chunk_labels.append(_chunk_labels)
+            sid += _sid
+            padded_token_num += _padded_token_num
+        self.num_pending -= 1
+        chunk_lids = np.concatenate(chunk_lids)
+        order = np.argsort(chunk_lids, kind="stable")
+        chunk_labels = np.concatenate(chunk_labels)[order]
+        return chunk_lids[order], [chunks[i] for i in order], [chunk_texts[i] for i in order], chunk_labels, sid, padded_token_num, busy_seconds
+
+    def close(self):
+        while self.num_pending > 0:
+            self.get()
+        for q in self.in_queues:
+            q.put(None)
+        for proc in self.procs:
+            proc.join()
+
+    def terminate(self):
+        for proc in self.procs:
+            proc.terminate()
+        # do not wait for the unread batches to be flushed at exit
+        for q in self.in_queues + self.out_queues:
+            q.cancel_join_thread()
+
+
+class Progress():
+    def __init__(self, args, output_path):
+        self.args = args
+        self.output_path = output_path
+        self.lid, self.sid, self.padded_token_num = 0, 0, 0
+        self.log_bytes_processed, self.log_doc_proccessed = 0, 0
+        self.global_start = time.time()
+        self.proc_start = self.global_start
+
+    def update(self, num_docs, bytes_processed, sid, padded_token_num):
+        last_lid = self.lid
+        self.lid += num_docs
+        self.log_bytes_processed += bytes_processed
+        self.log_doc_proccessed += num_docs
+        self.sid += sid
+        self.padded_token_num += padded_token_num
+        if self.lid // self.args.log_interval > last_lid // self.args.log_interval:
+            self.log()
+
+    def log(self):
+        current = time.time()
+        elapsed = current - self.proc_start
+        mbs = self.log_bytes_processed / elapsed / 1024 / 1024
+        ds = self.log_doc_proccessed / elapsed
+        tokens = (self.sid * self.args.max_length - self.padded_token_num) / 1e9
+
+        s = f"Processed {self.lid} documents. {self.sid} chunks. {tokens:.4f}B tokens. " + \
+            f"Padding fraction: {self.padded_token_num / (self.sid * self.args.max_length):.4f}." + \
+            f"({ds:.2f} docs/s, {mbs:.4f} MB/s). Total Time: {current - self.global_start} s."
+
+        print_and_save(s, self.output_path)
+
+        self.log_bytes_processed, self.log_doc_proccessed = 0, 0
+        self.proc_start = current
 
 
 def get_args():
@@ -143,20 +625,25 @@ def print_and_save(s, output_path):
         f.write(s + "\n")
 
 
-def get_ent_sent_infos(args, tokenizer):
-    with open(os.path.join(args.base_path, "tools", "process_data", f"end_sent_token_{args.model_type}.json"), "r") as f:
-        end_sent_token = json.load(f)
+def get_ent_sent_infos(args, tokenizer, vocab_tokens):
+    end_sent_token = load_end_sent_tokens(args.base_path, args.model_type, tokenizer, vocab_tokens)
     end_sent_mask = np.zeros(len(tokenizer), dtype=bool)
-    for token in end_sent_token:
-        end_sent_mask[token] = True
-    rt_token_mask = np.zeros(len(tokenizer), dtype=bool)
-    for token in end_sent_token:
-        if "\n" in tokenizer.decode([token]):
-            rt_token_mask[token] = True
+    end_sent_mask[end_sent_token] = True
+    rt_token_mask = end_sent_mask & np.array(["\n" in token for token in vocab_tokens], dtype=bool)
 
     return end_sent_mask, rt_token_mask
 
 
+def get_space_token_mask(tokenizer, vocab_tokens):
+    # " " in decode([a, b]) equals space_mask[a] or space_mask[b] only if decoding concatenates the
+    # tokens, which holds for byte-level BPE decoders without cleaning up the spaces.
+    # Otherwise, return None and the pairs are decoded (and cached) in the Writer.
+    decoder = getattr(getattr(tokenizer, "backend_tokenizer", None), "decoder", None)
+    if decoder is None or decoder.__class__.__name__ != "ByteLevel" or getattr(tokenizer, "clean_up_tokenization_spaces", False):
+        return None
+    return np.array([" " in token for token in vocab_tokens], dtype=bool)
+
+
 def main():
     args = get_args()
     random.seed(args.seed)
@@ -167,6 +654,7 @@ def main():
     dtype = best_fitting_dtype(len(tokenizer))
 
     output_path = os.path.join(output_path, args.model_type + "-" + str(args.max_length))
+    output_path = get_node_output_path(output_path, args.data_node_rank, args.data_n_nodes)
     os.makedirs(output_path, exist_ok=True)
         
     print_and_save(f"Tokenizer size: {len(tokenizer)}. Using dtype: {dtype}", output_path)
@@ -181,38 +669,73 @@ def main():
     with open(os.path.join(output_path, "args_get_paragraph.json"), "w") as f:
         json.dump(vars(args), f)
     
-    end_sent_mask, rt_token_mask = get_ent_sent_infos(args, tokenizer)
+    vocab_tokens = decode_vocab(tokenizer)
+    end_sent_mask, rt_token_mask = get_ent_sent_infos(args, tokenizer, vocab_tokens)
+    space_mask = get_space_token_mask(tokenizer, vocab_tokens)
+    print_and_save(f"Space token mask: {'precomputed' if space_mask is not None else 'decode token pairs'}", output_path)
+
+    telemetry = Telemetry(os.path.join(output_path, "telemetry.jsonl"), args.telemetry_interval, args.data_process_workers)
 
     builder = ChunkedDatasetBuilder(
             base_path=args.base_path,
             output_path=output_path,
             dtype=dtype,
             split="data",
-            do_shuffle=True)
+            do_shuffle=True,
+            text_sidecar=args.text_sidecar,
+            telemetry=telemetry)
 
     startup_start = time.time()
 
     print("input path", args.data_dir)
     print("Output path:", output_path)
 
-    sid, lid = 0, 0
-    log_bytes_processed, log_doc_proccessed = 0, 0
-    padded_token_num = 0
-
     with open(os.path.join(args.base_path, "tools", "process_data", f"domain_labels.json"), "r") as f:
         domain_labels = json.load(f)
-    writers = {}
 
     encoder = Encoder(args)
     pool = multiprocessing.Pool(
         args.data_process_workers, initializer=encoder.initializer)
-    
-    global_start = time.time()
+
+    if args.chunk_workers > 0:
+        chunker = DomainChunker(args, output_path, tokenizer, ChunkCollector(), domain_labels, end_sent_mask, rt_token_mask, dtype, space_mask=space_mask)
+        chunker_pool = ChunkerPool(args.chunk_workers, chunker)
+    else:
+        chunker = DomainChunker(args, output_path, tokenizer, builder, domain_labels, end_sent_mask, rt_token_mask, dtype, space_mask=space_mask)
+        chunker_pool = None
+
+    # the store is per node, documents are deduplicated within the data of this node
+    deduplicator = Deduplicator(os.path.join(output_path, "dedup_store"), args.dedup_store_shards) if args.dedup else None
+
+    progress = Progress(args, output_path)
+    # (lids, doc_lens) of the batches submitted to the chunker pool
+    pending_batches = []
+
+    def write_chunks():
+        # write the chunks of the earliest pending batch, return True if max_shard_num is reached
+        lids, doc_lens = pending_batches.pop(0)
+        st = time.time()
+        chunk_lids, chunks, chunk_texts, chunk_labels, sid, padded_token_num, busy_seconds = chunker_pool.get()
+        telemetry.add("chunk_wait", time.time() - st, count=len(lids))
+        telemetry.add("chunk_worker/busy", busy_seconds, count=len(lids))
+        for i, chunk in enumerate(chunks):
+            builder.add_np_item(chunk, texts=chunk_texts[i], label=int(chunk_labels[i]))
+            # check at the document boundaries, as in the main process chunking
+            if (i + 1 == len(chunks) or chunk_lids[i+1] != chunk_lids[i]) and builder.ofid >= args.max_shard_num:
+                # only count the documents written so far
+                num_docs = int(chunk_lids[i] - lids[0]) + 1
+                padded_token_num = sum([args.max_length - len(x) for x in chunks[:i+1]])
+                progress.update(num_docs, int(np.sum(doc_lens[:num_docs])), i + 1, padded_token_num)
+                return True
+        progress.update(len(lids), int(np.sum(doc_lens)), sid, padded_token_num)
+        return False
 
     if os.path.exists(os.path.join(args.base_path, "tools", "process_data", f"files_names.json")):
         with open(os.path.join(args.base_path, "tools", "process_data", f"files_names.json"), "r") as f:
             files_names = json.load(f)
     else:
+        # all nodes must split the same file list
+        assert args.data_n_nodes == 1, "files_names.json is required for multi-node processing. Create it with a single-node run."
         files_names = os.listdir(args.data_dir)
         random.shuffle(files_names)
         with open(os.path.join(args.base_path, "tools", "process_data", f"files_names.json"), "w") as f:
@@ -223,59 +746,71 @@ def main():
     print_and_save(f"Shard start: {args.shard_start}. Shard end: {args.shard_end}.", output_path)
     files_names = files_names[args.shard_start:args.shard_end]
 
-    proc_start = global_start
-        
-    for fid, file_name in enumerate(files_names):
-        print_and_save(f"Processing {file_name}. {fid}/{len(files_names)}", output_path)
-        input_file = os.path.join(args.data_dir, file_name)
-        fin = open(input_file)
-
-        # use the tokenizer to encode the sentences
-        encoded_docs = pool.imap(encoder.encode, enumerate(fin), 20)
-
-        for doc_tokens, doc_id, label, bytes_processed in encoded_docs:
-            lid += 1
-            log_bytes_processed += bytes_processed
-            log_doc_proccessed += 1
-            if label in writers:
-                writer = writers[label]
-            else:
-                label_idx = domain_labels[label]
-                writer = Writer(args, output_path, tokenizer, builder, label_idx, end_sent_mask, rt_token_mask, dtype)
-                writers[label] = writer
-
-            writer.add_tokens(doc_tokens, lid)
-            sid = sum([writers[k].sid for k in writers])
-            padded_token_num = sum([writers[k].padded_token_num for k in writers])
-            if lid % args.log_interval == 0:
-                current = time.time()
-                elapsed = current - proc_start
-                mbs = log_bytes_processed / elapsed / 1024 / 1024
-                ds = log_doc_proccessed / elapsed
-                tokens = (sid * args.max_length - padded_token_num) / 1e9
-
-                s = f"Processed {lid} documents. {sid} chunks. {tokens:.4f}B tokens. " + \
-                    f"Padding fraction: {padded_token_num / (sid * args.max_length):.4f}." + \
-                    f"({ds:.2f} docs/s, {mbs:.4f} MB/s). Total Time: {current - global_start} s."
-
-                print_and_save(s, output_path)
-
-                log_bytes_processed, log_doc_proccessed = 0, 0
-                proc_start = current
-
-            if builder.ofid >= args.max_shard_num:
-                break
+    ranges = get_byte_ranges([os.path.join(args.data_dir, file_name) for file_name in files_names], args.data_node_rank, args.data_n_nodes)
+    print_and_save(f"Node {args.data_node_rank}/{args.data_n_nodes}. Byte ranges: {ranges}", output_path)
+
+    # stream the batches of all files through the pool, so it does not drain at the file boundaries
+    # telemetry stages: read (the reader thread), worker/* (the tokenization workers), wait_encode
+    # (the main process waiting for them), dedup, chunk or chunk_submit/chunk_wait, and write
+    read_batches = telemetry.timed(read_file_batches(args, ranges, output_path), "read", nbytes=batch_bytes)
+    batches = background_iterator(read_batches, max_size=4 * args.data_process_workers, telemetry=telemetry)
+    encoded_batches = ordered_imap(pool, encoder.encode, batches, max_pending=4 * args.data_process_workers, telemetry=telemetry)
+    encoded_batches = telemetry.timed(encoded_batches, "wait_encode", nbytes=lambda x: int(x[0].nbytes))
+
+    lid = 0
+    finished = False
+    for buffer, offsets, labels, doc_lens, dedup_keys, texts, char_spans, stage_seconds in encoded_batches:
+        for stage, seconds in stage_seconds.items():
+            telemetry.add("worker/" + stage, seconds, count=len(labels))
+        if deduplicator is not None:
+            st = time.time()
+            keep = deduplicator.filter(labels, offsets, dedup_keys)
+            if texts is not None:
+                # the per-token char_spans are selected like the buffer
+                char_spans, _, texts, _ = select_docs(char_spans, offsets, texts, doc_lens, keep)
+            buffer, offsets, labels, doc_lens = select_docs(buffer, offsets, labels, doc_lens, keep)
+            telemetry.add("dedup", time.time() - st, count=len(keep))
+        lids = np.arange(lid + 1, lid + 1 + len(labels))
+        lid += len(labels)
+        st = time.time()
+        if chunker_pool is not None:
+            chunker_pool.submit(lids, labels, buffer, offsets, texts, char_spans)
+            telemetry.add("chunk_submit", time.time() - st, count=len(labels), nbytes=int(buffer.nbytes))
+            pending_batches.append((lids, doc_lens))
+            telemetry.gauge("chunk_pending", len(pending_batches))
+            # keep a few batches in flight per chunker
+            while len(pending_batches) > 2 * args.chunk_workers and not finished:
+                finished = write_chunks()
+        else:
+            for j, label in enumerate(labels):
+                if texts is not None:
+                    sid, padded_token_num = chunker.add_document(buffer[offsets[j]:offsets[j+1]], label, lids[j],
+                                                                 texts[j], char_spans[offsets[j]:offsets[j+1]])
+                else:
+                    sid, padded_token_num = chunker.add_document(buffer[offsets[j]:offsets[j+1]], label, lids[j])
+                progress.update(1, int(doc_lens[j]), sid, padded_token_num)
+                if builder.ofid >= args.max_shard_num:
+                    finished = True
+                    break
+            # includes the writes of the shards finished on the way
+            telemetry.add("chunk", time.time() - st, count=len(labels), nbytes=int(buffer.nbytes))
 
-        fin.close()
-        fin = None
-        
-        if builder.ofid >= args.max_shard_num:
+        telemetry.step(docs=progress.lid, chunks=progress.sid, shards=builder.ofid)
+        if finished:
             break
 
+    if chunker_pool is not None:
+        while len(pending_batches) > 0 and not finished:
+            finished = write_chunks()
+        if finished:
+            chunker_pool.terminate()
+        else:
+            chunker_pool.close()
+
     builder.finalize()
+    telemetry.flush(docs=progress.lid, chunks=progress.sid, shards=builder.ofid)
 
-    sid = sum([writers[k].sid for k in writers])
-    padded_token_num = sum([writers[k].padded_token_num for k in writers])
+    sid, padded_token_num = progress.sid, progress.padded_token_num
 
     # summarize
     print_and_save(f"Total time: {time.time() - startup_start}.", output_path)
@@ -284,8 +819,19 @@ def main():
     print_and_save(f"Total tokens: {total_tokens / 1e9:.4f}B", output_path)
     print_and_save(f"Total padding fraction: {padded_token_num / (sid * args.max_length)}.", output_path)
 
-    if fin is not None:
-        fin.close()
+    dedup_report = None
+    if deduplicator is not None:
+        dedup_report = deduplicator.report()
+        deduplicator.close()
+        for label, stats in sorted(dedup_report["domains"].items()) + [("Total", dedup_report["total"])]:
+            print_and_save(f"Dedup {label}: {stats['exact_dup_docs']} exact and {stats['near_dup_docs']} near duplicates " +
+                           f"of {stats['docs']} documents. Removed {stats['removed_tokens']} tokens " +
+                           f"({stats['removed_token_fraction']:.4f}).", output_path)
+        with open(os.path.join(output_path, "dedup_report.json"), "w") as f:
+            json.dump(dedup_report, f, indent=4)
+
+    write_manifest(output_path, node_rank=args.data_node_rank, n_nodes=args.data_n_nodes, num_tokens=int(total_tokens), inputs=ranges,
+                   dedup=dedup_report, text_sidecar=args.text_sidecar)
 
     pool.terminate()
     pool.close()
@@ -0,0 +1,20 @@
+import argparse
+
+from data_utils import stitch_manifests
+from arguments import add_data_args, add_model_args
+
+
+# Merge the per-node outputs of tokenize_pile.py / convert_tokenization.py run with --data-n-nodes N
+# into one dataset: node_{i}/data_{j} are renamed to data_{k} in --processed-data-dir.
+def main():
+    parser = argparse.ArgumentParser()
+    parser = add_model_args(add_data_args(parser))
+    args = parser.parse_args()
+
+    manifest = stitch_manifests(args.processed_data_dir, args.data_n_nodes, start_state=args.min_state)
+    num_samples = sum([x["num_samples"] for x in manifest["shards"]])
+    print(f"Stitched {len(manifest['shards'])} shards ({num_samples} samples) from {args.data_n_nodes} nodes to {args.processed_data_dir}")
+
+
+if __name__ == "__main__":
+    main()
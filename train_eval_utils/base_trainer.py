@@ -17,6 +17,9 @@ from torch.distributed import get_rank
 from torch.utils.data import DataLoader, DistributedSampler
 from torch.optim import AdamW, SGD, Adam
 from data_utils.prompt_datasets import PromptDataset
+from data_utils.samplers import ResumableDistributedSampler, LengthBucketedDistributedSampler
+from data_utils.permutation import PermutedDataOrder
+from data_utils.prefetcher import DevicePrefetcher
 
 from transformers import (
     GenerationConfig,
@@ -52,6 +55,7 @@ class BaseTrainer():
         self.epochs = None
         self.total_steps = None
         self.first_printed = False
+        self.last_sample_cursor = None
         if self.args.start_from_global_step is not None:
             self.last_global_steps = self.args.start_from_global_step
         
@@ -154,7 +158,7 @@ class BaseTrainer():
         self.last_steps = dynamics["step"]
         self.last_epochs = dynamics["epoch"]
         self.last_global_steps = dynamics["global_steps"]
-        self.train_dataset.set_skip_offset(dynamics["skip_offset"])
+        self.last_sample_cursor = dynamics.get("sample_cursor", None)
         
         print_and_save_rank(f"Resume from {load_dir} {tag}", os.path.join(self.args.save, "log.txt"))
         print_and_save_rank(f"Resume from step {self.last_steps}, epoch {self.last_epochs}, global step {self.last_global_steps}",
@@ -175,20 +179,20 @@ class BaseTrainer():
         if args.eval_interval == -1:
             args.eval_interval = self.train_iters_per_epoch
 
-        if self.args.precompute_data_order and (not self.args.resume_training):
-            if get_rank() == 0:
-                normal_order = np.arange(0, len(self.train_dataset), dtype=np.int32)
-                order = np.stack([np.random.permutation(normal_order) for _ in range(self.epochs)], axis=0)
-                order = order[:, :self.train_iters_per_epoch * self.total_batch_size] # droplast
-                np.save(os.path.join(self.args.save, "data_order.npy"), order)
-                print("Data order size: ", order.shape)
-            dist.barrier()
-            self.train_dataset.set_order(path=os.path.join(self.args.save, "data_order.npy"))
-                        
         if self.args.resume_training:
-            assert self.args.precompute_data_order
-            assert os.path.exists(os.path.join(self.args.save, "data_order.npy"))
-            self.train_dataset.set_order(path=os.path.join(self.args.save, "data_order.npy"))
+            assert self.args.precompute_data_order or self.args.length_bucketing
+        
+        if self.args.length_bucketing:
+            assert not self.args.precompute_data_order, "Length bucketing decides the data order itself"
+
+        if self.args.precompute_data_order:
+            order_path = os.path.join(self.args.save, "data_order.npy")
+            if self.args.resume_training and os.path.exists(order_path):
+                # runs started with a materialized data order
+                self.train_dataset.set_order(order_path)
+            else:
+                self.train_dataset.set_order(PermutedDataOrder(len(self.train_dataset), self.epochs, self.args.seed_data))
+            print_and_save_rank(f"Data order size: {self.train_dataset.order.shape}", os.path.join(args.save, "log.txt"))
 
         print_and_save_rank(f"Total batch size: {self.total_batch_size}", os.path.join(args.save, "log.txt"))
         print_and_save_rank(f"Total iters: {self.total_steps}", os.path.join(args.save, "log.txt"))
@@ -200,11 +204,31 @@ class BaseTrainer():
         self.train_dataloader, self.train_sampler = self.get_train_sampler_dataloader()
     
     def get_train_sampler_dataloader(self):
-        train_sampler = DistributedSampler(self.train_dataset, shuffle=((not self.args.precompute_data_order) and (not self.args.no_shuffle)), drop_last=True, rank=self.dp_rank, num_replicas=self.dp_world_size)
+        if self.args.length_bucketing:
+            train_sampler = LengthBucketedDistributedSampler(
+                self.train_dataset, self.train_dataset.get_sizes(), self.args.batch_size, self.args.max_length,
+                bucket_size=self.args.bucket_size, shuffle=(not self.args.no_shuffle), seed=self.args.seed_data,
+                rank=self.dp_rank, num_replicas=self.dp_world_size)
+            train_dataloader = DataLoader(
+                self.train_dataset, sampler=train_sampler, batch_size=self.args.batch_size, num_workers=self.args.num_workers, collate_fn=self.train_dataset.collate, drop_last=True, pin_memory=True)
+            return train_dataloader, train_sampler
+        train_sampler = ResumableDistributedSampler(self.train_dataset, shuffle=((not self.args.precompute_data_order) and (not self.args.no_shuffle)), drop_last=True, rank=self.dp_rank, num_replicas=self.dp_world_size)
         train_dataloader = DataLoader(
-            self.train_dataset, sampler=train_sampler, batch_size=self.args.batch_size, num_workers=self.args.num_workers, collate_fn=self.train_dataset.collate, drop_last=True)
+            self.train_dataset, sampler=train_sampler, batch_size=self.args.batch_size, num_workers=self.args.num_workers, collate_fn=self.train_dataset.collate, drop_last=True, pin_memory=True)
         return train_dataloader, train_sampler
     
+    def get_resume_cursor(self):
+        # (epoch, number of samples consumed by all ranks in that epoch)
+        epoch_size = self.train_iters_per_epoch * self.total_batch_size
+        if self.args.resume_training and self.last_sample_cursor is not None:
+            epoch, sample_cursor = self.last_epochs, self.last_sample_cursor
+        else:
+            epoch = self.last_global_steps // self.train_iters_per_epoch
+            sample_cursor = (self.last_global_steps % self.train_iters_per_epoch) * self.total_batch_size
+        if sample_cursor >= epoch_size:
+            epoch, sample_cursor = epoch + 1, 0
+        return epoch, sample_cursor
+
     def prepare_inference(self, args=None):
         pass
      
@@ -224,7 +248,7 @@ class BaseTrainer():
     def compute_loss(self, model_batch, no_model_batch):
         raise NotImplementedError
 
-    def _get_lm_loss_from_logits(self, logits, label, loss_mask):        
+    def _get_lm_loss_from_logits(self, logits, label, loss_mask, segment_ids=None):        
         if self.args.model_parallel:
             loss_func = mpu.parallel_cross_entropy
             lm_losses = loss_func(logits.contiguous().float(), label)
@@ -232,15 +256,35 @@ class BaseTrainer():
             loss_func = nn.CrossEntropyLoss(reduction="none")
             lm_losses = loss_func(logits.float().view(-1, logits.shape[-1]), label.view(-1))
             lm_losses = lm_losses.view(-1, label.size(-1))
+        if segment_ids is not None:
+            # packed rows: sum the token losses of each sample
+            num = int(segment_ids.max().item()) + 1
+            valid = segment_ids >= 0
+            sample_losses = torch.zeros(num, device=lm_losses.device).index_add_(0, segment_ids[valid], (lm_losses * loss_mask)[valid])
+            sample_tokens = torch.zeros(num, device=lm_losses.device).index_add_(0, segment_ids[valid], loss_mask[valid])
+            assert all(sample_tokens > 0)
+            return sample_losses / sample_tokens
         assert all(torch.sum(loss_mask, dim=-1) > 0)
         lm_loss = torch.sum((lm_losses * loss_mask), dim=-1) / torch.sum(loss_mask, dim=-1)
         return lm_loss
 
+    def get_model_inputs(self, model_batch):
+        if "attention_mask" in model_batch and model_batch["attention_mask"].dim() == 4:
+            # packed rows with a boolean block-diagonal mask
+            if self.args.attn_impl == "flash_attention_2":
+                # the sample boundaries are found from the restarting position_ids
+                return {k: v for k, v in model_batch.items() if k != "attention_mask"}
+            dtype = torch.float32 if self.args.fp32 else torch.float16
+            attention_mask = torch.zeros(model_batch["attention_mask"].size(), dtype=dtype, device=model_batch["attention_mask"].device)
+            attention_mask.masked_fill_(~model_batch["attention_mask"], torch.finfo(dtype).min)
+            return {**model_batch, "attention_mask": attention_mask}
+        return model_batch
+
     def compute_lm_loss(self, model_batch, no_model_batch, mean=True):        
-        outputs = self.model(**model_batch, use_cache=False)
+        outputs = self.model(**self.get_model_inputs(model_batch), use_cache=False)
         logits = outputs.logits
 
-        lm_loss = self._get_lm_loss_from_logits(logits, no_model_batch["label"], no_model_batch["loss_mask"])
+        lm_loss = self._get_lm_loss_from_logits(logits, no_model_batch["label"], no_model_batch["loss_mask"], no_model_batch.get("segment_ids", None))
         
         if mean:
             lm_loss = lm_loss.mean()            
@@ -283,7 +327,7 @@ class BaseTrainer():
                 print(self.tokenizer.decode(model_batch["input_ids"][0].cpu().tolist(), skip_special_tokens=True))
                 print("#### Size:", model_batch["input_ids"].size(), "####")
                 print("#### input_ids END ####")
-            if "attention_mask" in model_batch:
+            if "attention_mask" in model_batch and model_batch["attention_mask"].dim() == 2:
                 print("#### attention_mask BEGIN ####")
                 print(model_batch["attention_mask"][0].cpu().tolist())
                 print("#### attention_mask END ####")
@@ -368,36 +412,40 @@ class BaseTrainer():
         assert self.epochs is not None
         assert self.total_steps is not None
         
-        for epoch in range(0, self.epochs):
+        start_epoch, start_sample_cursor = 0, 0
+        restore_rng_states = False
+        if self.args.resume_training or (self.args.start_from_global_step is not None):
+            start_epoch, start_sample_cursor = self.get_resume_cursor()
+            self.steps = self.last_global_steps * self.args.gradient_accumulation_steps
+            self.global_steps = self.last_global_steps + 1
+            restore_rng_states = self.args.resume_training
+            print_and_save_rank(f"Starting from global step {self.global_steps}, epoch {start_epoch}, sample cursor {start_sample_cursor}",
+                                os.path.join(self.args.save, "log.txt"))
+        
+        for epoch in range(start_epoch, self.epochs):
             self.set_train()
             self.epoch = epoch
             if isinstance(self.train_sampler, DistributedSampler):
                 self.train_sampler.set_epoch(epoch)
+            if isinstance(self.train_sampler, LengthBucketedDistributedSampler):
+                print_and_save_rank(f"Length bucketing epoch {epoch}: {self.train_sampler.padding_stats}", os.path.join(self.args.save, "log.txt"))
+            if epoch == start_epoch and start_sample_cursor > 0:
+                assert isinstance(self.train_sampler, ResumableDistributedSampler)
+                self.train_sampler.set_start(start_sample_cursor)
             self.train_dataset.set_epoch(epoch)
             self.preepoch_callback()
-            for it, (model_batch, no_model_batch) in enumerate(self.train_dataloader):
-                if self.args.resume_training or (self.args.start_from_global_step is not None):
-                    if self.global_steps <= self.last_global_steps:
-                        if (self.steps % self.args.gradient_accumulation_steps == 0) and (self.global_steps % 1000 == 0):
-                            print_and_save_rank(f"Skipping global step {self.global_steps}", os.path.join(self.args.save, "log.txt"))                        
-                        self.steps += 1
-                        if self.steps % self.args.gradient_accumulation_steps == 0:
-                            self.global_steps += 1
-                        continue
-                    if (self.steps % self.args.gradient_accumulation_steps == 0):
-                        print_and_save_rank(f"Starting from global step {self.global_steps}", os.path.join(self.args.save, "log.txt"))
-                        if self.args.resume_training:
-                            torch.set_rng_state(self.last_rng_states["torch"])
-                            torch.cuda.set_rng_state(self.last_rng_states["cuda"])
-                            np.random.set_state(self.last_rng_states["numpy"])
-                            random.setstate(self.last_rng_states["python"])
+            for it, (model_batch, no_model_batch) in enumerate(DevicePrefetcher(self.train_dataloader, self.device)):
+                if restore_rng_states:
+                    torch.set_rng_state(self.last_rng_states["torch"])
+                    torch.cuda.set_rng_state(self.last_rng_states["cuda"])
+                    np.random.set_state(self.last_rng_states["numpy"])
+                    random.setstate(self.last_rng_states["python"])
+                    restore_rng_states = False
 
                 if not self.first_printed:
                     self.first_print(model_batch, no_model_batch, "train")
                     self.first_printed = True
 
-                self.train_dataset.move_to_device(model_batch, no_model_batch, self.device)
-                                
                 stats = {}
                 stats = self._train_pass(model_batch, no_model_batch, stats)
                                 
@@ -511,16 +559,15 @@ class BaseTrainer():
         eval_dataset = eval_dataset or self.eval_dataset
         eval_sampler = DistributedSampler(eval_dataset, shuffle=False, drop_last=False, rank=self.dp_rank, num_replicas=self.dp_world_size)
         eval_dataloader = DataLoader(
-            eval_dataset, sampler=eval_sampler, batch_size=self.args.eval_batch_size, num_workers=self.args.num_workers, collate_fn=eval_dataset.collate)
+            eval_dataset, sampler=eval_sampler, batch_size=self.args.eval_batch_size, num_workers=self.args.num_workers, collate_fn=eval_dataset.collate, pin_memory=True)
         
         self.model.eval()
         all_losses = []
                     
         with torch.no_grad():
-            for i, (model_batch, no_model_batch) in enumerate(tqdm(eval_dataloader, f"LM Evaluation", disable=(not get_rank() == 0))):
+            for i, (model_batch, no_model_batch) in enumerate(tqdm(DevicePrefetcher(eval_dataloader, self.device), f"LM Evaluation", disable=(not get_rank() == 0))):
                 if i == 0 and self.dp_rank == 0:
                     self.first_print(model_batch, no_model_batch, f"eval_{eval_dataset.data_name}")
-                eval_dataset.move_to_device(model_batch, no_model_batch, self.device)
                 loss = self.compute_lm_loss(model_batch, no_model_batch, mean=False)
                 all_losses.append(loss)
         
@@ -659,7 +706,7 @@ class BaseTrainer():
                             "step": self.steps,
                             "epoch": self.epoch,
                             "global_steps": global_steps,
-                            "skip_offset": (self.epoch, global_steps * self.total_batch_size)
+                            "sample_cursor": (global_steps - self.epoch * self.train_iters_per_epoch) * self.total_batch_size
                         }, f)
             if get_rank() == 0:
                 self.model.module.save_pretrained(ckpt_dir, safe_serialization=False)
@@ -13,6 +13,7 @@ from pretrain.trainer import PreTrainer
 
 class VanillaKDPreTrainer(PreTrainer):
     def __init__(self, args, ds_config, device, do_train=True):
+        assert not args.pack_samples, "Packed samples are not supported in vanilla KD"
         super().__init__(args, ds_config, device, do_train)
         self.setup_teacher_model()
         